@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+'''Benchmarks of ORM hot paths.
+
+Runs against local MySQL/MariaDB from db.con_params. When driver or
+server isn't available then SQLite backend is used. Results are saved in json, so
+they can be compared between releases.
+
+Usage:
+  python benchmarks/bench_orm.py --output results.json
+  python benchmarks/bench_orm.py --sqlite --compare results.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db import Model, Field
+
+
+class BenchModel(Model):
+    name = Field(blank=False)
+    category = Field(blank=True)
+    amount = Field(blank=True)
+    created = Field(blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+MYSQL_TABLE = '''
+CREATE TABLE benchmodel (
+    id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+    amount INT,
+    category CHAR(10),
+    created DATETIME,
+    name CHAR(60) NOT NULL
+)'''
+
+SQLITE_TABLE = '''
+CREATE TABLE benchmodel (
+    id INTEGER PRIMARY KEY,
+    amount INT,
+    category CHAR(10),
+    created DATETIME,
+    name CHAR(60) NOT NULL
+)'''
+
+CATEGORIES = ['work', 'home', 'shop', 'sport', 'other']
+
+benchmarks = []
+
+
+def benchmark(name):
+    '''Registers function which prepares benchmark.
+
+    Decorated function takes Context and returns tuple of callable which
+    is measured and number of operations done in one call.
+    '''
+    def register(func):
+        benchmarks.append((name, func))
+        return func
+    return register
+
+
+class Context:
+
+    '''Data shared by benchmarks.
+
+    Attributes:
+      rows (int): Number of rows in table.
+      ids (list): Ids of rows in table.
+      fetched (list): Raw rows like fetched from database.
+    '''
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.ids = []
+        self.fetched = []
+
+
+def new_values(number):
+    return {'name': 'Event %i' % number,
+            'category': CATEGORIES[number % len(CATEGORIES)],
+            'amount': number,
+            'created': datetime(2015, 5, 13, 12, number % 60)}
+
+
+def new_row(number):
+    '''Returns tuple of values in the order of fields.'''
+
+    values = new_values(number)
+    return tuple(values.get(field) for field in BenchModel.Fields)
+
+
+@benchmark('connect')
+def bench_connect(context):
+    def run():
+        db.connect().close()
+    return run, 1
+
+
+@benchmark('execute_sql')
+def bench_execute_sql(context):
+    def run():
+        db.execute_sql('SELECT 1').fetchone()
+    return run, 1
+
+
+@benchmark('get')
+def bench_get(context):
+    def run():
+        BenchModel.objects.get(id=random.choice(context.ids))
+    return run, 1
+
+
+@benchmark('filter_scan')
+def bench_filter_scan(context):
+    def run():
+        list(BenchModel.objects.filter(category='home').order_by('-id'))
+    return run, 1
+
+
+@benchmark('save_loop')
+def bench_save_loop(context):
+    def run():
+        for number in range(10):
+            BenchModel(**new_values(number)).save()
+    return run, 10
+
+
+@benchmark('create_loop')
+def bench_create_loop(context):
+    def run():
+        for number in range(10):
+            BenchModel.objects.create(**new_values(number))
+    return run, 10
+
+
+@benchmark('bulk_insert')
+def bench_bulk_insert(context):
+    rows = [new_row(number) for number in range(100)]
+
+    def run():
+        BenchModel.objects._bulk_insert(rows, batch_size=100)
+    return run, len(rows)
+
+
+@benchmark('hydration')
+def bench_hydration(context):
+    def run():
+        for row in context.fetched:
+            value = BenchModel._value_parse_to_dict(*row)
+            instance = BenchModel(**value)
+            instance.id = value['id']
+    return run, len(context.fetched)
+
+
+@benchmark('json')
+def bench_json(context):
+    def run():
+        BenchModel.objects.all()[100].json()
+    return run, 100
+
+
+# Microbenchmarks without round trip to database
+
+
+@benchmark('build_query')
+def bench_build_query(context):
+    def run():
+        for number in range(100):
+            query = BenchModel.objects.filter(
+                category='home', amount__gte=number).order_by('-id')[0:20]
+            query._build_query()
+    return run, 100
+
+
+@benchmark('build_update')
+def bench_build_update(context):
+    instance = BenchModel(**new_values(1))
+    instance.id = 1
+
+    def run():
+        for _ in range(100):
+            instance.objects._create_update_sql()
+    return run, 100
+
+
+# Database
+
+
+def use_sqlite():
+    '''Selects SQLite backend with database in temporary directory.'''
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    db.use_backend('sqlite', database=path)
+    return 'sqlite %s' % sqlite3.sqlite_version
+
+
+def use_mysql():
+    '''Returns version of server or None if it isn't available.'''
+
+    backend = db.get_backend()
+    try:
+        conn = backend.connect()
+    except ImportError:
+        return None
+    except backend.Error:
+        return None
+    cursor = conn.cursor()
+    cursor.execute('SELECT VERSION()')
+    (version, ) = cursor.fetchone()
+    conn.close()
+    return 'mysql %s' % version
+
+
+def prepare_table(context, engine):
+    db.execute_sql('DROP TABLE IF EXISTS benchmodel')
+    if engine.startswith('mysql'):
+        db.execute_sql(MYSQL_TABLE)
+    else:
+        db.execute_sql(SQLITE_TABLE)
+    rows = [new_row(number) for number in range(context.rows)]
+    BenchModel.objects._bulk_insert(rows)
+    cursor = db.execute_sql(BenchModel._simple_query())
+    context.fetched = list(cursor)
+    context.ids = [row[0] for row in context.fetched]
+
+
+# Runner
+
+
+def measure(run, ops, repeat, warmup):
+    '''Returns statistics of one operation in seconds.'''
+
+    for _ in range(warmup):
+        run()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) / ops)
+    timings.sort()
+    mean = statistics.mean(timings)
+    return {
+        'repeat': repeat,
+        'ops_per_call': ops,
+        'mean': mean,
+        'median': statistics.median(timings),
+        'min': timings[0],
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'ops_per_sec': 1 / mean if mean else None,
+    }
+
+
+def run_benchmarks(rows=1000, repeat=50, warmup=5, names=None,
+                   sqlite=False):
+    engine = None if sqlite else use_mysql()
+    if engine is None:
+        engine = use_sqlite()
+    context = Context(rows)
+    prepare_table(context, engine)
+    results = {}
+    for name, prepare in benchmarks:
+        if names and name not in names:
+            continue
+        run, ops = prepare(context)
+        results[name] = measure(run, ops, repeat, warmup)
+    db.execute_sql('DROP TABLE benchmodel')
+    return {
+        'meta': {
+            'engine': engine,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.now().isoformat(),
+            'rows': rows,
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    '''Prints change of mean time and returns names of regressions.'''
+
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            print('%-12s %12.1f us  (new)' % (name, result['mean'] * 1e6))
+            continue
+        ratio = result['mean'] / before['mean']
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = '  REGRESSION'
+            regressions.append(name)
+        print('%-12s %12.1f us  %+6.1f%%%s' % (
+            name, result['mean'] * 1e6, (ratio - 1) * 100, mark))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='number of rows in table')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--only', nargs='*', metavar='NAME',
+                        help='names of benchmarks: %s' % ', '.join(
+                            name for name, _ in benchmarks))
+    parser.add_argument('--sqlite', action='store_true',
+                        help='use SQLite even if MySQL is available')
+    parser.add_argument('--output', help='path of json file with results')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='json file with results of previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown against baseline')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.rows, args.repeat, args.warmup, args.only,
+                            args.sqlite)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline),
+                                  args.threshold)
+        return 1 if regressions else 0
+    if not args.output:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,27 @@
 # -*- coding: utf-8 -*-
 
-import MySQLdb
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import atexit
+import bisect
+import copy
+import csv
+import heapq
+import itertools
 import json
+import logging
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+import traceback
+import warnings
+import zlib
 
 con_params = {
     'db': '',
@@ -34,70 +53,279 @@ class Query(metaclass=BasicQuery):
       instance : Instance of model.
       klass: Class of model.
       _q (str): Query for database.
+      _params (list): Params of query.
       _conditions (dict): All conditions from filter.
-      _order_by (str): Description of order how returns list of instance.
-      _limit (str): Simple MySQL limit statement.
+      _order_by (tuple): Pairs of field and direction ('ASC' or 'DESC').
+      _limit (tuple): Number of rows and offset (or None).
+      _using (str): Alias of database from using or None, then router
+        selects database.
+      _timeout (float): Timeout of query in seconds or None.
+      _targets (list): Aliases of databases for built query.
+      _merge (tuple): Order and limit for merging rows from shards.
+
+    Note:
+      New query is created by every access to Model.objects, so attributes
+      which aren't mutated have defaults in class.
     '''
 
+    _using = None
+    _q = None
+    _order_by = None
+    _limit = None
+    _timeout = None
+    _targets = None
+    _merge = None
+
     def __init__(self, instance, klass):
         self.instance = instance
         self.klass = klass
-        self._q = None
+        self._params = []
         self._conditions = {}
-        self._order_by = None
-        self._limit = None
 
     def __call__(self):
-        '''Returns list of model instance.'''
+        '''Returns list of model instance (Deferred inside batch).'''
 
+        batch = current_batch()
+        if batch is not None and self._q is not None:
+            shards = self._targets_of_query()
+            if len(shards) > 1:
+                self._prepare_merge()
+            else:
+                self._build_query()
+            return batch.defer(
+                [(using, self._q, self._params or None) for using in shards],
+                lambda results: list(self._instances(self._merged(results))),
+                model=self.klass)
         return list(self.__iter__())
 
     def __iter__(self):
         if self._q is None:
-            raise StopIteration
+            return
+        shards = self._targets_of_query()
+        if len(shards) > 1:
+            response_elements = self._fetch_from_shards(shards)
         else:
             self._build_query()
-            response_elements = execute_sql(self._q)
-            if response_elements is None:
-                raise StopIteration
-            for row in response_elements:
-                (*value, ) = row
-                value = self.klass._value_parse_to_dict(*value)
-                instance = self.klass(**value)
-                instance.id = value['id']
-                yield instance
+            response_elements = execute_sql(self._q, self._params or None,
+                                            model=self.klass,
+                                            operation='select',
+                                            using=shards[0],
+                                            timeout=self._timeout)
+        yield from self._instances(response_elements)
+
+    def _instances(self, rows):
+        '''Yields instances of model from rows.'''
+
+        for row in rows:
+            (*value, ) = row
+            yield self._hydrate(self.klass._value_parse_to_dict(*value))
+
+    def _hydrate(self, value):
+        '''Returns instance of model from dict of fields values.'''
+
+        instance = self.klass(**value)
+        instance.id = value['id']
+        instance._remember_shard_key()
+        return instance
 
     def __len__(self):
-        return len(self.__call__())
+        # Isn't deferred in batch
+        return len(list(self.__iter__()))
 
     def __repr__(self):
-        return str(self.__call__())
+        return str(list(self.__iter__()))
 
     def __getitem__(self, value):
         if isinstance(value, int):
-            self._limit = 'LIMIT %i ' % value
+            self._limit = (value, None)
         elif isinstance(value, slice):
             try:
                 start_stop = (int(value.start), int(value.stop))
-                start_number = (start_stop[0], start_stop[1] - start_stop[0])
-            except ValueError:
+            except (TypeError, ValueError):
                 pass
             else:
-                self._limit = 'LIMIT %s, %s ' % start_number
+                self._limit = (start_stop[1] - start_stop[0], start_stop[0])
+        return self
+
+    @property
+    def backend(self):
+        '''Backend of database with dialect of query.
+
+        Note:
+          Replicas have this same dialect like primary and all shards
+          like the first shard.
+        '''
+        return self.klass._backend(self._using)
+
+    def using(self, alias):
+        '''Selects database for query instead of router.
+
+        Args:
+          alias (str): 'primary', 'replica' or alias of backend.
+
+        Returns:
+          Instance of Query.
+
+        Examples:
+          Model.objects.using('primary').get(id=5)
+        '''
+        self._using = alias
+        return self
+
+    def timeout(self, seconds):
+        '''Sets timeout of query instead of timeout of backend.
+
+        Returns:
+          Instance of Query.
+
+        Examples:
+          Model.objects.filter(person='@all').timeout(0.5).json()
+        '''
+        self._timeout = seconds
         return self
 
     def _build_query(self):
         if self._conditions:
-            self._q += ' ' + \
-                self._parse_conditions_to_sql(**self._conditions)
+            sql_query, params = self._parse_conditions_to_sql(
+                **self._conditions)
+            self._q += sql_query
+            self._params.extend(params)
             self._conditions = {}
         if self._order_by:
-            self._q += ' ' + self._order_by
+            self._q += ' ' + self._parse_order_by_to_sql(self._order_by)
             self._order_by = None
         if self._limit:
-            self._q += ' ' + self._limit
+            self._q += ' ' + self.backend.limit(*self._limit)
             self._limit = None
 
+    def _shards(self, values=None):
+        '''Returns list of aliases of databases for query.
+
+        Model without shard map uses database from using or router (None).
+        Query of sharded model goes to shard of shard key from values
+        or to all shards.
+
+        Args:
+          values (dict, optional): Conditions or fields values.
+        '''
+        shard_map = self.klass.ShardMap
+        if shard_map is None or self._using is not None:
+            return [self._using]
+        if values and shard_map.field in values:
+            return [shard_map.shard_for(values[shard_map.field])]
+        return list(shard_map.aliases)
+
+    def _targets_of_query(self):
+        '''Returns aliases of databases for conditions of query.
+
+        Note:
+          Conditions are removed when query is built, aliases are kept
+          for the next iterations.
+        '''
+        if self._targets is None:
+            self._targets = self._shards(self._conditions)
+        return self._targets
+
+    def _instance_values(self):
+        return dict((field, getattr(self.instance, field))
+                    for field in self.klass.Fields)
+
+    def _instance_shard(self):
+        '''Returns alias of shard where instance is saved.
+
+        Raises:
+          ValueError: Shard key of saved instance was changed.
+        '''
+        values = self._instance_values()
+        shard_map = self.klass.ShardMap
+        if shard_map is not None and hasattr(self.instance, '_saved_shard_key'):
+            saved = self.instance._saved_shard_key
+            if values[shard_map.field] != saved:
+                raise ValueError("Shard key %s of %s can't be changed"
+                                 % (shard_map.field, self.klass.__name__))
+        (using, ) = self._shards(values)
+        return using
+
+    def _check_id_lookup(self, values):
+        '''Raises ValueError if id without shard key can't select one row.
+
+        Ids of model sharded by other field are generated by every shard,
+        so this same id can be in all shards.
+        '''
+        shard_map = self.klass.ShardMap
+        if (shard_map is not None and self._using is None and
+                shard_map.field != 'id' and 'id' in values and
+                shard_map.field not in values):
+            raise ValueError('Ids of %s are unique only in shard, query by '
+                             'id needs shard key %s'
+                             % (self.klass.__name__, shard_map.field))
+
+    def _fetch_from_shards(self, shards):
+        '''Fetches rows from all shards concurrently and merges them.
+
+        Note:
+          Every shard returns offset + number of rows in limit, rows are
+          merged in order from order_by and sliced.
+        '''
+        self._prepare_merge()
+
+        def fetch(alias):
+            return list(execute_sql(self._q, self._params or None,
+                                    model=self.klass, operation='select',
+                                    using=alias, timeout=self._timeout))
+        return self._merged(fan_out(shards, fetch))
+
+    def _prepare_merge(self):
+        '''Builds query for shards, order and limit are kept for merging.'''
+
+        if self._merge is None:
+            self._merge = (self._order_by, self._limit)
+            if self._limit is not None:
+                count, offset = self._limit
+                self._limit = (count + (offset or 0), None)
+            self._build_query()
+
+    def _merged(self, results):
+        '''Merges lists of rows from shards, one list is returned as is.'''
+
+        if self._merge is None:
+            (rows, ) = results
+            return rows
+        order, limit = self._merge
+        if order:
+            rows = merge_sorted(results, order, self.klass.Fields)
+        else:
+            rows = itertools.chain(*results)
+        if limit is not None:
+            count, offset = limit
+            rows = itertools.islice(rows, offset or 0, (offset or 0) + count)
+        return rows
+
+    def iterator(self):
+        '''Yields instances of model without loading all rows into memory.
+
+        Note:
+          Rows are read with streaming cursor of backend, for MySQL it is
+          server side cursor on own connection. Query to many shards
+          is merged in memory.
+        '''
+        if self._q is None:
+            return
+        shards = self._targets_of_query()
+        if len(shards) > 1:
+            yield from self.__iter__()
+            return
+        self._build_query()
+        using = router.route('select', shards[0])
+        backend = get_backend(using)
+        with backend.streaming_cursor() as cursor:
+            with instrumented(self._q, self._params or None, self.klass,
+                              'select', using) as event:
+                backend.execute(cursor, self._q, self._params or None)
+                event.rowcount = cursor.rowcount
+            for row in cursor:
+                yield self._hydrate(self.klass._value_parse_to_dict(*row))
+
     def create(self, raw_json=None, **kwargs):
         '''Saves to databases and returns instance of model.
 
@@ -112,10 +340,168 @@ class Query(metaclass=BasicQuery):
             kwargs_from_json = json.loads(raw_json)
             kwargs.update(kwargs_from_json)
         instance = self.klass(**kwargs)
+        shard_map = self.klass.ShardMap
+        if shard_map is not None and shard_map.field == 'id':
+            # Ids of models sharded by id are generated by application
+            instance.id = kwargs.get('id', None)
+            if instance.is_valid():
+                instance.save(force_insert=True)
+            return instance
         if instance.is_valid():
             instance.save()
         return instance
 
+    def load_file(self, path, format='csv', mapping=None, batch_size=1000,
+                  local_infile=True):
+        '''Bulk loads records from file and returns report of loading.
+
+        Every record is validated like in create. Valid records are
+        streamed to temporary file and loaded with MySQL LOAD DATA LOCAL
+        INFILE. When it isn't available (server or client disabled
+        local_infile) or model is sharded records are saved with batched
+        multi-row INSERTs. Records aren't kept in memory.
+
+        Args:
+          path (str): Path to the file.
+          format (str, optional): 'csv' (first row is header) or 'ndjson'
+            (one json object per line). Defaults to 'csv'.
+          mapping (dict, optional): Names of columns in file mapped on names
+            of fields in model. Defaults to None, names are this same.
+          batch_size (int, optional): Number of rows in one INSERT.
+          local_infile (bool, optional): If false then only INSERTs are used.
+
+        Returns:
+          Instance of LoadReport.
+
+        Examples:
+          EventModel.objects.load_file('events.csv', mapping={'Who': 'person'})
+        '''
+        start = time.time()
+        report = LoadReport()
+        counts = None
+        if local_infile:
+            counts = self._load_data_infile(
+                self._valid_rows(path, format, mapping, report))
+        method = 'load_data'
+        if counts is None:
+            # Records are read again, LOAD DATA wasn't available
+            method = 'insert'
+            report.rejected = 0
+            rows = self._valid_rows(path, format, mapping, report)
+            valid = loaded = 0
+            for batch in iter(lambda: list(itertools.islice(rows, batch_size)),
+                              []):
+                valid += len(batch)
+                loaded += self._bulk_insert(batch, batch_size)
+            counts = (valid, loaded)
+        valid, report.loaded = counts
+        if valid:
+            report.method = method
+        report.rejected += valid - report.loaded
+        report.elapsed = time.time() - start
+        return report
+
+    def _valid_rows(self, path, format, mapping, report):
+        '''Yields valid records as rows and counts rejected in report.'''
+
+        for record in read_records(path, format, mapping):
+            if record is None:
+                report.rejected += 1
+                continue
+            instance = self.klass(**record)
+            instance.id = record.get('id', None)
+            if not instance.is_valid():
+                report.rejected += 1
+                continue
+            yield tuple(getattr(instance, field)
+                        for field in self.klass.Fields)
+
+    def _load_data_infile(self, rows):
+        '''Loads rows with LOAD DATA LOCAL INFILE.
+
+        Rows are written to temporary file one by one.
+
+        Returns:
+          Tuple of numbers of written and loaded rows or None if LOAD DATA
+          isn't available.
+        '''
+        if self.klass.ShardMap is not None:
+            return None
+        using = router.route('load', self._using)
+        backend = get_backend(using)
+        if not backend.supports_load_data:
+            return None
+        sql = self.klass._sql(backend)
+        # File is in utf-8 whatever is default charset of database
+        sql_query = ('LOAD DATA LOCAL INFILE %s INTO TABLE %s '
+                     'CHARACTER SET utf8mb4 (%s)'
+                     % (backend.placeholder, sql['table'], sql['columns']))
+        valid = 0
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='',
+                                         suffix='.tsv', delete=False) as tmp:
+            for row in rows:
+                tmp.write('\t'.join(infile_value(value) for value in row))
+                tmp.write('\n')
+                valid += 1
+        if not valid:
+            os.remove(tmp.name)
+            return (0, 0)
+        try:
+            with instrumented(sql_query, (tmp.name, ), model=self.klass,
+                              operation='load', using=using) as event:
+                conn = backend.connect(local_infile=1)
+                try:
+                    cursor = conn.cursor()
+                    backend.execute(cursor, sql_query, (tmp.name, ))
+                    conn.commit()
+                    event.rowcount = cursor.rowcount
+                    return (valid, cursor.rowcount)
+                finally:
+                    conn.close()
+        except backend.Error:
+            return None
+        finally:
+            os.remove(tmp.name)
+
+    def _bulk_insert(self, rows, batch_size=1000):
+        '''Saves rows with multi-row INSERTs and returns number saved rows.
+
+        Note:
+          Rows of sharded model are grouped by shard.
+        '''
+        shard_map = self.klass.ShardMap
+        if shard_map is not None and self._using is None:
+            position = self.klass.Fields.index(shard_map.field)
+            groups = defaultdict(list)
+            for row in rows:
+                groups[shard_map.shard_for(row[position])].append(row)
+        else:
+            groups = {self._using: rows}
+        loaded = 0
+        for using, rows in groups.items():
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                sql_query, params = self._create_bulk_insert_sql(batch)
+                cursor = execute_sql(sql_query, params, model=self.klass,
+                                     operation='insert', using=using)
+                loaded += cursor.rowcount
+        return loaded
+
+    def _create_bulk_insert_sql(self, rows):
+        '''Creates multi-row INSERT query and flat list of params for it.
+
+        Examples:
+          Fields = ('id', 'name')
+          [(None, 'Beer'), (None, 'Cat')]
+          ('INSERT INTO `model` (`id`, `name`) VALUES (%s, %s), (%s, %s)',
+           [None, 'Beer', None, 'Cat'])
+        '''
+        sql = self.klass._sql(self.backend)
+        sql_query = 'INSERT INTO %s (%s) VALUES %s' % (
+            sql['table'], sql['columns'], ', '.join([sql['row']] * len(rows)))
+        params = [value for row in rows for value in row]
+        return sql_query, params
+
     def delete(self, id=None):
         '''Delete model from databases.
 
@@ -123,10 +509,15 @@ class Query(metaclass=BasicQuery):
           id: Id of model which should be remove.
         '''
         if id is not None or self.instance.id:
-            table_name = self.klass.__name__.lower()
-            sql = 'DELETE FROM %s WHERE id = %s' % (table_name,
-                                                    id or self.instance.id)
-            execute_sql(sql)
+            sql = self.klass._sql(self.backend)['delete']
+            if id is None:
+                shards = [self._instance_shard()]
+            else:
+                self._check_id_lookup({'id': id})
+                shards = self._shards({'id': id})
+            for using in shards:
+                execute_sql(sql, (id or self.instance.id, ), model=self.klass,
+                            operation='delete', using=using)
 
     def get_or_create(self, raw_json=None, **kwargs):
         '''Gets or creates model and returns instance.
@@ -144,7 +535,8 @@ class Query(metaclass=BasicQuery):
             kwargs.update(kwargs_from_json)
         instance = None
         if kwargs.get('id', None):
-            instance = self.get(id=kwargs['id'])
+            # Isn't deferred in batch, create needs result
+            instance = self._get({'id': kwargs['id']})
         # instance can be empty
         if not instance:
             instance = self.create(**kwargs)
@@ -158,20 +550,45 @@ class Query(metaclass=BasicQuery):
           resp_json (bool): If true then returns json, otherwise instance.
 
         Returns:
-          If exist then return instance of model or json.
+          If exist then return instance of model or json (Deferred
+          inside batch).
         '''
-        sql_query = self.klass._simple_query()
-        sql_query += self._parse_conditions_to_sql(**kwargs)
-        try:
-            (*value, ) = execute_sql(sql_query).fetchone()
-        except (TypeError, AttributeError):
-            return None
-        value = self.klass._value_parse_to_dict(*value)
-        if resp_json:
-            return json.dumps(value, default=json_serial)
-        instance = self.klass(**value)
-        instance.id = value['id']
-        return instance
+        return self._get(kwargs, resp_json, current_batch())
+
+    def _get(self, kwargs, resp_json=False, batch=None):
+        '''Returns instance of Model, it is deferred if batch is given.'''
+
+        self._check_id_lookup(kwargs)
+        sql_query = self.klass._sql(self.backend)['select']
+        conditions, params = self._parse_conditions_to_sql(**kwargs)
+
+        def build(rows):
+            try:
+                (*value, ) = next(row for row in rows if row is not None)
+            except StopIteration:
+                return None
+            value = self.klass._value_parse_to_dict(*value)
+            if resp_json:
+                return json.dumps(value, default=json_serial)
+            return self._hydrate(value)
+
+        if batch is not None:
+            return batch.defer(
+                [(using, sql_query + conditions, params)
+                 for using in self._shards(kwargs)],
+                lambda results: build(rows[0] if rows else None
+                                      for rows in results),
+                model=self.klass, operation='get')
+        loader = self.klass.Loader
+        if (loader is not None and list(kwargs) == ['id'] and
+                self._using is None and not pinned_to_primary()):
+            return build([loader.load(self, kwargs['id'])])
+
+        def fetch(using):
+            return execute_sql(sql_query + conditions, params,
+                               model=self.klass, operation='get',
+                               using=using, timeout=self._timeout).fetchone()
+        return build(fan_out(self._shards(kwargs), fetch))
 
     def all(self):
         '''Prepares query for returns all instance from databases
@@ -179,7 +596,7 @@ class Query(metaclass=BasicQuery):
         Returns:
           Instance of Query.
         '''
-        self._q = self.klass._simple_query()
+        self._q = self.klass._sql(self.backend)['select']
         return self
 
     def filter(self, **kwargs):
@@ -191,7 +608,7 @@ class Query(metaclass=BasicQuery):
         Returns:
           Instance of Query.
         '''
-        self._q = self.klass._simple_query()
+        self._q = self.klass._sql(self.backend)['select']
         self._conditions.update(kwargs)
         return self
 
@@ -208,30 +625,35 @@ class Query(metaclass=BasicQuery):
           Model.objects.all().order_by('id') # ASC
           Model.objects.all().order_by('-id') # DESC
         '''
-        sql_query = 'ORDER BY '
         if not args:
-            self._order_by = sql_query + 'id ASC'
+            self._order_by = (('id', 'ASC'), )
             return self
+        order = []
         for key in args:
-            if sql_query != 'ORDER BY ':
-                sql_query += ', '
             if key.startswith('-'):
-                sql_query += key[1:] + ' DESC'
+                order.append((key[1:], 'DESC'))
             else:
-                sql_query += key + ' ASC'
-        self._order_by = sql_query
+                order.append((key, 'ASC'))
+        self._order_by = tuple(order)
         return self
 
     def count(self):
         '''Returns number model records in databases'''
 
-        table_name = self.klass.__name__.lower()
-        sql_query = 'SELECT COUNT(*) FROM %s' % table_name
-        try:
-            (number, ) = execute_sql(sql_query).fetchone()
-        except AttributeError:
-            return None
-        return number
+        sql_query = self.klass._sql(self.backend)['count']
+        batch = current_batch()
+        if batch is not None:
+            return batch.defer(
+                [(using, sql_query, None) for using in self._shards()],
+                lambda results: sum(number for ((number, ), ) in results),
+                model=self.klass, operation='count')
+
+        def fetch(using):
+            (number, ) = execute_sql(sql_query, model=self.klass,
+                                     operation='count', using=using,
+                                     timeout=self._timeout).fetchone()
+            return number
+        return sum(fan_out(self._shards(), fetch))
 
     def execute_query(self, query):
         '''Execute query for databases and returns list of instance
@@ -245,6 +667,32 @@ class Query(metaclass=BasicQuery):
         self._q = query
         return list(self)
 
+    def explain(self, format='json'):
+        '''Returns plan of query from EXPLAIN, query isn't changed.
+
+        Args:
+          format (str, optional): 'json' returns parsed plan (EXPLAIN
+            FORMAT=JSON on MySQL), 'traditional' returns rows of EXPLAIN
+            as dicts. SQLite has only rows of EXPLAIN QUERY PLAN.
+
+        Note:
+          Query of sharded model without shard key is explained
+          on the first shard.
+
+        Examples:
+          Model.objects.filter(person='@all').order_by('-date').explain()
+          {'query_block': {'select_id': 1, 'ordering_operation': {
+              'using_filesort': True, 'table': {'access_type': 'ALL', ...}}}}
+        '''
+        if self._q is None:
+            return None
+        query = copy.copy(self)
+        query._params = list(self._params)
+        (using, *_) = query._targets_of_query()
+        query._build_query()
+        return explain(query._q, query._params or None, model=self.klass,
+                       using=using, format=format)
+
     def json(self):
         '''Returns result of query in json.'''
 
@@ -257,26 +705,25 @@ class Query(metaclass=BasicQuery):
         return json.dumps(instances_list, default=json_serial)
 
     def _parse_conditions_to_sql(self, **kwargs):
-        sql_query = ' WHERE '
-        for key, value in kwargs.items():
-            if not sql_query.endswith('WHERE '):
-                sql_query += ' AND '
-            key, sign = self._parse_to_sign(key)
-            sql_query += '%s %s \'%s\'' % (key, sign, value)
-        return sql_query
+        '''Returns WHERE statement and list of params for it.'''
+
+        where = self.klass._sql(self.backend)['where']
+        try:
+            conditions = [where[key] for key in kwargs]
+        except KeyError as error:
+            raise ValueError('Unknown lookup of %s: %s'
+                             % (self.klass.__name__, error.args[0]))
+        return ' WHERE ' + ' AND '.join(conditions), list(kwargs.values())
+
+    def _parse_order_by_to_sql(self, order):
+        quote = self.backend.quote
+        return 'ORDER BY ' + ', '.join('%s %s' % (quote(field), direction)
+                                       for field, direction in order)
 
     def _parse_to_sign(self, key):
-        signs = {'': '=', 'lt': '<', 'lte': '<=',
-                 'gt': '>', 'gte': '>=', 'like': 'like'}
-        for field in self.klass.Fields:
-            for sign in signs:
-                if sign == '':
-                    underscore = ''
-                else:
-                    underscore = '__'
-                temp_key = field + underscore + sign
-                if temp_key == key:
-                    return field, signs[sign]
+        '''Returns field and operator of lookup, e.g. ('id', '<=') for id__lte.'''
+
+        return self.klass.Lookups.get(key)
 
     def update(self, raw_json=None, resp_json=False, **kwargs):
         '''Updates a record from kwargs or from json
@@ -288,41 +735,49 @@ class Query(metaclass=BasicQuery):
           kwargs: This same name like fields in model with value for updates.
         '''
         if self.instance:
-            execute_sql(self._create_update_sql())
+            execute_sql(*self._create_update_sql(), model=self.klass,
+                        operation='update', using=self._instance_shard())
         else:
             if raw_json is not None:
                 kwargs_from_json = json.loads(raw_json)
                 kwargs.update(kwargs_from_json)
-            execute_sql(self._create_update_sql_from_kwargs(**kwargs))
+            shard_map = self.klass.ShardMap
+            if (shard_map is not None and self._using is None and
+                    shard_map.field != 'id'):
+                if shard_map.field in kwargs:
+                    raise ValueError("Shard key %s of %s can't be updated"
+                                     % (shard_map.field, self.klass.__name__))
+                self._check_id_lookup(kwargs)
+            sql_query, params = self._create_update_sql_from_kwargs(**kwargs)
+            for using in self._shards(kwargs):
+                execute_sql(sql_query, params, model=self.klass,
+                            operation='update', using=using)
             if kwargs.get('id', None):
                 if resp_json:
-                    return self.get(id=kwargs['id'], resp_json=True)
-                return self.get(id=kwargs['id'])
+                    return self._get({'id': kwargs['id']}, resp_json=True)
+                return self._get({'id': kwargs['id']})
 
     def _create_update_sql_from_kwargs(self, **kwargs):
-        table_name = self.klass.__name__.lower()
-        sql_query = 'UPDATE %s SET ' % table_name
+        sql = self.klass._sql(self.backend)
+        assignments = []
+        params = []
         for field, value in kwargs.items():
-            if field in self.klass.Fields:
-                if not sql_query.endswith('SET '):
-                    sql_query += ', '
-                sql_query += '%s = \'%s\'' % (field, value)
+            if field in sql['quoted']:
+                assignments.append(sql['where'][field])
+                params.append(value)
+        sql_query = 'UPDATE %s SET %s' % (sql['table'], ', '.join(assignments))
         if kwargs.get('id', None):
-            sql_query += ' WHERE id = %i' % kwargs['id']
-        return sql_query
+            sql_query += sql['where_id']
+            params.append(kwargs['id'])
+        return sql_query, params
 
     def _create_update_sql(self):
         '''
-            Create query SQL when exist instance of Model
+            Create query SQL and params when exist instance of Model
         '''
-        table_name = self.klass.__name__.lower()
-        sql_query = 'UPDATE %s SET ' % table_name
-        for i in self.klass.Fields:
-            if not sql_query.endswith('SET '):
-                sql_query += ', '
-            sql_query += '%s = \'%s\'' % (i, getattr(self.instance, i))
-        sql_query += ' WHERE id = %i' % self.instance.id
-        return sql_query
+        params = [getattr(self.instance, i) for i in self.klass.Fields]
+        params.append(self.instance.id)
+        return self.klass._sql(self.backend)['update'], params
 
 
 class Field:
@@ -334,13 +789,21 @@ class Field:
         null (bool, optional): Describes whether field can be null in databases.
         blank (bool, optional): Describes whether field can be blank.
         default (optional): Default value which will be used for save to databases.
+        unique (bool, optional): Describes whether field has unique index.
+        db_index (bool, optional): Describes whether field has index.
+        db_type (str, optional): Type of column, e.g. 'DATETIME' or 'CHAR(12)'.
+          Defaults to None, backend uses own default type.
     '''
 
-    def __init__(self, primary_key=False, null=True, blank=True, default=None):
+    def __init__(self, primary_key=False, null=True, blank=True, default=None,
+                 unique=False, db_index=False, db_type=None):
         self.primary_key = primary_key
         self.null = null
         self.blank = blank
         self.default = default
+        self.unique = unique
+        self.db_index = db_index
+        self.db_type = db_type
 
     def __get__(self, instance, klass):
         return getattr(instance, str(id(self)))
@@ -361,8 +824,385 @@ class Field:
         return validation
 
 
+class Index:
+
+    '''Represents index of table.
+
+    Attributes:
+        fields (tuple): Names of fields, name with prefix '-' is descending.
+        unique (bool, optional): Describes whether index is unique.
+        name (str, optional): Name of index. Defaults to None, then name is
+          built from name of table and fields.
+
+    Examples:
+        class Meta:
+            indexes = ['person', ('person', '-date'), Index('text', unique=True)]
+    '''
+
+    def __init__(self, *fields, unique=False, name=None):
+        self.fields = fields
+        self.unique = unique
+        self.name = name
+
+    def __repr__(self):
+        return '<Index: %s%s>' % (', '.join(self.fields),
+                                  ' unique' if self.unique else '')
+
+    def __eq__(self, other):
+        return (isinstance(other, Index) and self.fields == other.fields and
+                self.unique == other.unique)
+
+    def __hash__(self):
+        return hash((self.fields, self.unique))
+
+    @property
+    def columns(self):
+        '''Names of fields without order'''
+
+        return tuple(field.lstrip('-') for field in self.fields)
+
+    def index_name(self, table_name):
+        if self.name:
+            return self.name
+        return '%s_%s_%s' % (table_name, '_'.join(self.columns),
+                             'uniq' if self.unique else 'idx')
+
+
+class ShardMap:
+
+    '''Base class of map of shards, it selects shard for value of field.
+
+    Attributes:
+        field (str): Name of field which is shard key.
+        aliases (tuple): Aliases of databases registered by use_backend.
+    '''
+
+    def __init__(self, field, aliases):
+        self.field = field
+        self.aliases = tuple(aliases)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.field)
+
+    def shard_for(self, value):
+        '''Returns alias of shard for value of shard key.'''
+
+        raise NotImplementedError
+
+
+class HashShardMap(ShardMap):
+
+    '''Selects shard by CRC32 of value.
+
+    Examples:
+        class Meta:
+            shard_map = HashShardMap('person', ['shard0', 'shard1'])
+    '''
+
+    def shard_for(self, value):
+        if value is None:
+            raise ValueError('Value of shard key %s is required' % self.field)
+        checksum = zlib.crc32(str(value).encode('utf-8'))
+        return self.aliases[checksum % len(self.aliases)]
+
+
+class RangeShardMap(ShardMap):
+
+    '''Selects shard by range of value.
+
+    Attributes:
+        ranges (list): Pairs of the lowest value in range and alias.
+
+    Examples:
+        class Meta:
+            shard_map = RangeShardMap('id', [(0, 'shard0'), (10 ** 6, 'shard1')])
+    '''
+
+    def __init__(self, field, ranges):
+        self.ranges = sorted(ranges, key=lambda pair: pair[0])
+        self._starts = [start for start, _ in self.ranges]
+        super().__init__(field, [alias for _, alias in self.ranges])
+
+    def shard_for(self, value):
+        if value is None:
+            raise ValueError('Value of shard key %s is required' % self.field)
+        position = bisect.bisect_right(self._starts, value) - 1
+        if position < 0:
+            raise ValueError('Value %r of shard key %s is out of ranges'
+                             % (value, self.field))
+        return self.ranges[position][1]
+
+
+class Loader:
+
+    '''Coalesces concurrent get(id=...) of model into one query.
+
+    The first caller waits for other callers at most wait seconds (or until
+    there are max_batch_size ids), then loads all ids with one
+    WHERE id IN (...) query. Ids are deduplicated and every caller gets own
+    instance. Reads in transaction, in request_scope after write and with
+    using aren't coalesced.
+
+    Attributes:
+      max_batch_size (int): The most number of ids in one query.
+      wait (float): Time in seconds of collecting ids.
+      batches (int): Number of executed queries.
+      loads (int): Number of coalesced calls of get.
+
+    Examples:
+      class Meta:
+          loader = Loader(max_batch_size=100, wait=0.002)
+    '''
+
+    def __init__(self, max_batch_size=100, wait=0.001):
+        self.max_batch_size = max_batch_size
+        self.wait = wait
+        self.batches = 0
+        self.loads = 0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Loader: max_batch_size=%s, wait=%s>' % (self.max_batch_size,
+                                                         self.wait)
+
+    def load(self, query, id):
+        '''Returns row of model with id or None if it doesn't exist.'''
+
+        with self._lock:
+            self.loads += 1
+            pending = self._pending
+            leader = pending is None
+            if leader:
+                pending = self._pending = _PendingLoad()
+            pending.ids.setdefault(str(id), id)
+            if len(pending.ids) >= self.max_batch_size:
+                # Next callers start new batch
+                self._pending = None
+                pending.full.set()
+        if leader:
+            pending.full.wait(self.wait)
+            with self._lock:
+                if self._pending is pending:
+                    self._pending = None
+                self.batches += 1
+            try:
+                pending.rows = self._fetch(query, list(pending.ids.values()))
+            except Exception as error:
+                pending.error = error
+            finally:
+                pending.done.set()
+        else:
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.rows.get(str(id))
+
+    def _fetch(self, query, ids):
+        '''Returns dict of str(id) -> row, ids are grouped by shard.'''
+
+        sql = query.klass._sql(query.backend)
+        position = query.klass.Fields.index('id')
+        groups = defaultdict(list)
+        for id in ids:
+            for using in query._shards({'id': id}):
+                groups[using].append(id)
+
+        def fetch(using):
+            statement = '%s WHERE %s IN (%s)' % (
+                sql['select'], sql['quoted']['id'],
+                ', '.join([query.backend.placeholder] * len(groups[using])))
+            return list(execute_sql(statement, groups[using],
+                                    model=query.klass, operation='get',
+                                    using=using))
+        return {str(row[position]): row
+                for rows in fan_out(list(groups), fetch) for row in rows}
+
+
+class BufferFull(Exception):
+
+    '''Write-behind buffer is full and it wasn't flushed in timeout.'''
+
+
+class WriteBehind:
+
+    '''Buffer of new instances of model which are saved in background.
+
+    save() and create() of new instances put rows into bounded buffer and
+    return immediately without id. Background thread saves rows with
+    multi-row INSERTs when there are batch_size rows or after interval.
+    When buffer is full save() waits at most timeout seconds (backpressure)
+    and then raises BufferFull. Buffer is flushed at exit of interpreter.
+
+    Note:
+      Inserts in transaction are saved immediately. Rows which database
+      rejected are logged to logger 'db.write_behind' and counted in failed.
+
+    Attributes:
+      max_size (int): Capacity of buffer in rows.
+      batch_size (int): The most number of rows in one INSERT.
+      interval (float): The longest time in seconds of row in buffer.
+      timeout (float): Time in seconds of waiting for place in full buffer,
+        None waits until there is place.
+      model: Class of model, it is set by BasicModel.
+      written (int): Number of saved rows.
+      failed (int): Number of rejected rows.
+      flushes (int): Number of writes of rows.
+      flush_time (float): Total time in seconds of writes.
+      last_flush_latency (float): Time in seconds of the last write.
+
+    Examples:
+      class Meta:
+          write_behind = WriteBehind(max_size=10000, batch_size=500,
+                                     interval=0.5)
+    '''
+
+    def __init__(self, max_size=10000, batch_size=500, interval=0.5,
+                 timeout=5.0):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.model = None
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.last_flush_latency = None
+        self.logger = logging.getLogger('db.write_behind')
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+
+    def __repr__(self):
+        return '<WriteBehind: %s, depth=%s>' % (
+            getattr(self.model, '__name__', None), self.depth)
+
+    @property
+    def depth(self):
+        '''Number of rows waiting in buffer.'''
+
+        return self._queue.qsize()
+
+    def put(self, row):
+        '''Adds row in the order of fields to buffer.
+
+        Raises:
+          BufferFull: Buffer is full after timeout.
+        '''
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put(row, timeout=self.timeout)
+        except queue.Full:
+            raise BufferFull('Write-behind buffer of %s is full (%i rows)'
+                             % (self.model.__name__, self.max_size))
+
+    def flush(self):
+        '''Saves all rows from buffer and waits for rows in progress.'''
+
+        while True:
+            rows = self._take(self.batch_size)
+            if not rows:
+                break
+            self._write(rows)
+        self._queue.join()
+
+    def close(self):
+        '''Flushes buffer and stops background thread.'''
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stop.set()
+        # Worker saves rows which it took from buffer and ends
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def snapshot(self):
+        '''Returns dict of metrics of buffer.'''
+
+        return {'depth': self.depth, 'max_size': self.max_size,
+                'written': self.written, 'failed': self.failed,
+                'flushes': self.flushes, 'flush_time': self.flush_time,
+                'last_flush_latency': self.last_flush_latency}
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                # Every worker has own stop event, so old worker can't
+                # continue after new one is started
+                self._stop = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._stop, ), daemon=True,
+                    name='db-write-behind-%s' % self.model.__name__)
+                self._thread.start()
+                atexit.unregister(self.close)
+                atexit.register(self.close)
+
+    def _run(self, stop):
+        while not stop.is_set():
+            try:
+                rows = [self._queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    rows.append(self._queue.get(timeout=max(remaining, 0)))
+                except queue.Empty:
+                    break
+            self._write(rows)
+
+    def _take(self, count):
+        rows = []
+        while len(rows) < count:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _write(self, rows):
+        start = time.perf_counter()
+        try:
+            written = self.model.objects._bulk_insert(rows, self.batch_size)
+        except Exception:
+            written = 0
+            self.logger.exception('Write-behind of %i rows of %s failed',
+                                  len(rows), self.model.__name__)
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.written += written
+            self.failed += len(rows) - written
+            self.flushes += 1
+            self.flush_time += latency
+            self.last_flush_latency = latency
+        for _ in rows:
+            self._queue.task_done()
+
+
+class _PendingLoad:
+
+    '''Ids collected by Loader and their rows.'''
+
+    def __init__(self):
+        self.ids = {}
+        self.rows = {}
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
 class BasicModel(type):
 
+    # Operators of lookups, e.g. filter(id__lte=5)
+    signs = {'': '=', 'lt': '<', 'lte': '<=',
+             'gt': '>', 'gte': '>=', 'like': 'like'}
+
     def __new__(meta, classname, supers, classdict):
         fields = {}
         for klass in supers:
@@ -372,7 +1212,99 @@ class BasicModel(type):
         fields.pop('pk', None)
         classdict['Fields'] = tuple(sorted(fields))
         meta.create_validation_for_field(classdict, fields)
-        return type.__new__(meta, classname, supers, classdict)
+        cls = type.__new__(meta, classname, supers, classdict)
+        cls.Indexes = meta.parse_indexes(cls, fields)
+        cls.Lookups = meta.parse_lookups(classdict['Fields'])
+        # SQL fragments per dialect of backend, see Model._sql
+        cls.Fragments = {}
+        cls.ShardMap = getattr(getattr(cls, 'Meta', None), 'shard_map', None)
+        if cls.ShardMap is not None and cls.ShardMap.field not in fields:
+            raise ValueError('Shard map of %s has unknown field: %s'
+                             % (classname, cls.ShardMap.field))
+        # Loader and buffer keep state of one model, so they are taken
+        # only from own Meta, not from Meta of base class
+        own_meta = classdict.get('Meta')
+        cls.Loader = getattr(own_meta, 'loader', None)
+        if (cls.Loader is not None and cls.ShardMap is not None and
+                cls.ShardMap.field != 'id'):
+            raise ValueError('Loader of %s needs model sharded by id, ids '
+                             'are unique only in shard' % classname)
+        cls.WriteBehind = getattr(own_meta, 'write_behind', None)
+        if cls.WriteBehind is not None:
+            if cls.WriteBehind.model is not None:
+                raise ValueError('Write-behind buffer of %s is used by %s'
+                                 % (classname, cls.WriteBehind.model.__name__))
+            cls.WriteBehind.model = cls
+        return cls
+
+    @classmethod
+    def parse_lookups(meta, fields):
+        '''Builds dict of lookup -> (field, operator) for all fields.
+
+        Examples:
+          Fields = ('id', )
+          {'id': ('id', '='), 'id__lt': ('id', '<'), ...}
+        '''
+        lookups = {}
+        for field in fields:
+            for sign, operator in meta.signs.items():
+                key = field + '__' + sign if sign else field
+                lookups[key] = (field, operator)
+        return lookups
+
+    @staticmethod
+    def build_fragments(cls, backend):
+        '''Builds dict of SQL fragments of model for dialect of backend.'''
+
+        quoted = {field: backend.quote(field) for field in cls.Fields}
+        table = backend.quote(cls.__name__.lower())
+        columns = ', '.join(quoted[field] for field in cls.Fields)
+        row = '(%s)' % ', '.join([backend.placeholder] * len(cls.Fields))
+        where = {key: '%s %s %s' % (quoted[field], operator,
+                                    backend.placeholder)
+                 for key, (field, operator) in cls.Lookups.items()}
+        where_id = ' WHERE ' + where['id']
+        return {
+            'table': table,
+            'columns': columns,
+            'quoted': quoted,
+            'row': row,
+            'where': where,
+            'where_id': where_id,
+            'select': 'SELECT %s FROM %s' % (columns, table),
+            'count': 'SELECT COUNT(*) FROM %s' % table,
+            'insert': 'INSERT INTO %s (%s) VALUES %s' % (table, columns, row),
+            'update': 'UPDATE %s SET %s%s' % (
+                table, ', '.join(where[field] for field in cls.Fields),
+                where_id),
+            'delete': 'DELETE FROM %s%s' % (table, where_id),
+        }
+
+    @staticmethod
+    def parse_indexes(cls, fields_dict):
+        '''Builds tuple of indexes from fields and from Meta.indexes'''
+
+        indexes = []
+        for field in sorted(fields_dict):
+            value = fields_dict[field]
+            if value.primary_key:
+                continue
+            if value.unique:
+                indexes.append(Index(field, unique=True))
+            elif value.db_index:
+                indexes.append(Index(field))
+        for index in getattr(getattr(cls, 'Meta', None), 'indexes', ()):
+            if isinstance(index, str):
+                index = Index(index)
+            elif not isinstance(index, Index):
+                index = Index(*index)
+            for field in index.columns:
+                if field not in fields_dict:
+                    raise ValueError('Index of %s has unknown field: %s'
+                                     % (cls.__name__, field))
+            if index not in indexes:
+                indexes.append(index)
+        return tuple(indexes)
 
     @classmethod
     def parse_fields(cls, klass):
@@ -427,21 +1359,38 @@ class Model(metaclass=BasicModel):
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.__str__())
 
-    def save(self):
+    def save(self, force_insert=False):
         '''
-            Saved is only if doesn't has id, else run update
+            Saved is only if doesn't has id or force_insert, else run update.
+            New instance of model with write-behind is added to buffer.
         '''
-        if self.id is None:
-            table_name = self.__class__.__name__.lower()
-            sql_query = '''INSERT INTO %s (%s) values%s ''' % (
-                table_name, self._parse_fields(), self._fields_values_to_str())
-            cursor = execute_sql(sql_query)
-            if cursor is not None:
-                self.id = cursor.lastrowid
+        buffer = self.__class__.WriteBehind
+        if (buffer is not None and (self.id is None or force_insert) and
+                not getattr(_local, 'transactions', 0)):
+            buffer.put(self._fields_values())
+            return self
+        if self.id is None or force_insert:
+            query = self.objects
+            backend = query.backend
+            (using, ) = query._shards(query._instance_values())
+            cursor = execute_sql(self._sql(backend)['insert'],
+                                 self._fields_values(),
+                                 model=self.__class__, operation='insert',
+                                 using=using)
+            if self.id is None:
+                self.id = backend.last_insert_id(cursor)
+            self._remember_shard_key()
         else:
             self.update()
         return self
 
+    def _remember_shard_key(self):
+        '''Keeps value of shard key which is saved in database.'''
+
+        shard_map = self.__class__.ShardMap
+        if shard_map is not None:
+            self._saved_shard_key = getattr(self, shard_map.field)
+
     def update(self):
         '''Update record databases of current instance'''
 
@@ -467,30 +1416,105 @@ class Model(metaclass=BasicModel):
                 return False
         return True
 
-    def _fields_values_to_str(self):
-        '''Parse fields values into string.
-
-        Prepared tuple in string of object fields
-        values in the order of fields.
+    @classmethod
+    def create_table(cls):
+        '''Creates table with indexes if it doesn't exist (on all shards).
 
         Note:
-          If only one field then assume it is 'id'
-          field then should be null for save.
+          Missing indexes are created when table already exists.
+        '''
+        table_name = cls.__name__.lower()
+        for using in cls.objects._shards():
+            using = router.alias(using)
+            backend = get_backend(using)
+            if backend.table_columns(table_name, using):
+                statements = _index_migration(cls, backend, using)
+            else:
+                statements = cls.schema_sql()
+            for sql_query in statements:
+                execute_sql(sql_query, model=cls, operation='schema',
+                            using=using)
+
+    @classmethod
+    def drop_table(cls):
+        '''Removes table if it exists (on all shards).'''
+
+        for using in cls.objects._shards():
+            execute_sql('DROP TABLE IF EXISTS %s' % cls._table_name(),
+                        model=cls, operation='schema', using=using)
+
+    @classmethod
+    def sync_schema(cls, drop_indexes=False):
+        '''Creates table, missing columns and indexes.
+
+        Args:
+          drop_indexes (bool, optional): If true then removes indexes which
+            aren't declared in model.
 
         Returns:
-          String of fields value.
+          List of executed SQL queries.
+        '''
+        statements = []
+        for using in cls.objects._shards():
+            migration = make_migration(cls, drop_indexes=drop_indexes,
+                                       using=using)
+            for sql_query in migration:
+                execute_sql(sql_query, model=cls, operation='schema',
+                            using=using)
+            statements.extend(migration)
+        return statements
+
+    @classmethod
+    def schema_sql(cls):
+        '''Returns list of queries which create table and indexes.'''
+
+        backend = cls.objects.backend
+        columns = ',\n    '.join(
+            '%s %s' % (backend.quote(field), cls._column_sql(field))
+            for field in sorted(cls.Fields, key=lambda field: field != 'id'))
+        statements = ['CREATE TABLE IF NOT EXISTS %s (\n    %s\n)'
+                      % (cls._table_name(), columns)]
+        for index in cls.Indexes:
+            statements.append(cls._create_index_sql(index))
+        return statements
+
+    @classmethod
+    def _column_sql(cls, field):
+        '''Returns type of column with NOT NULL if field can't be null.'''
+
+        backend = cls.objects.backend
+        if field == 'id':
+            return backend.primary_key_type
+        value = BasicModel.parse_fields(cls)[field]
+        column = value.db_type or backend.default_type
+        if not value.null:
+            column += ' NOT NULL'
+        return column
+
+    @classmethod
+    def _create_index_sql(cls, index):
+        quote = cls.objects.backend.quote
+        columns = ', '.join(
+            quote(field[1:]) + ' DESC' if field.startswith('-')
+            else quote(field) for field in index.fields)
+        return 'CREATE %sINDEX %s ON %s (%s)' % (
+            'UNIQUE ' if index.unique else '',
+            quote(index.index_name(cls.__name__.lower())),
+            cls._table_name(), columns)
+
+    def _fields_values(self):
+        '''Returns tuple of object fields values in the order of fields.
+
+        Note:
+          Id of new object is None, database saves it as NULL
+          and generates new id.
 
         Examples:
           Fields = ('id', 'list_id', 'name')
           {'name': 'Something', 'list_id': 5}
-          (5, 'Something)
+          (None, 5, 'Something')
         '''
-        if len(self.__class__.Fields) == 1:
-            return "(NULL)"
-        value = []
-        for i in self.__class__.Fields:
-            value.append(getattr(self, i))
-        return (str(tuple(value))).replace('None', 'NULL')
+        return tuple(getattr(self, i) for i in self.__class__.Fields)
 
     @classmethod
     def _value_parse_to_dict(cls, *value):
@@ -507,56 +1531,1890 @@ class Model(metaclass=BasicModel):
             dict_values[field] = value
         return dict_values
 
+    @classmethod
+    def _backend(cls, using=None):
+        '''Returns backend with dialect of model for using.
+
+        Note:
+          Replicas have this same dialect like primary and all shards
+          like the first shard.
+        '''
+        if using is None and cls.ShardMap is not None:
+            return get_backend(cls.ShardMap.aliases[0])
+        return get_backend(router.alias(using))
+
+    @classmethod
+    def _sql(cls, backend=None):
+        '''Returns dict of SQL fragments for dialect of backend.
+
+        Fragments are built once per model and dialect (quote character
+        and placeholder), queries only join them.
+
+        Examples:
+          Fields = ('id', 'name')
+          {'table': '`model`', 'columns': '`id`, `name`',
+           'select': 'SELECT `id`, `name` FROM `model`',
+           'where': {'id': '`id` = %s', 'name__like': '`name` like %s', ...},
+           ...}
+        '''
+        if backend is None:
+            backend = cls._backend()
+        dialect = (backend.quote_char, backend.placeholder)
+        try:
+            return cls.Fragments[dialect]
+        except KeyError:
+            return cls.Fragments.setdefault(
+                dialect, BasicModel.build_fragments(cls, backend))
+
     @classmethod
     def _simple_query(cls):
         '''Simple SQL query with names of fields and table name'''
 
-        return 'SELECT %s FROM %s' % (cls._parse_fields(), cls.__name__.lower())
+        return cls._sql()['select']
+
+    @classmethod
+    def _table_name(cls):
+        '''Quoted name of table, this same like name of class in lower case'''
+
+        return cls._sql()['table']
 
     @classmethod
     def _parse_fields(cls):
         '''Parse model fields into string.
 
         Returns:
-          Returns string of fields name.
+          Returns string of quoted fields name.
 
         Examples:
           Fields = ('id', 'list_id', 'name')
-          tuple_of_fields = 'id, list_id, name'
+          tuple_of_fields = '`id`, `list_id`, `name`'
         '''
-        tuple_of_fields = ''
-        for key in cls.Fields:
-            if tuple_of_fields != '':
-                tuple_of_fields += ', '
-            tuple_of_fields += key
-        return tuple_of_fields
+        return cls._sql()['columns']
 
     objects = Query()
 
-# Helpers
 
+class LoadReport:
 
-def connect():
-    return MySQLdb.connect(**con_params)
+    '''Report of bulk loading from file.
 
+    Attributes:
+      loaded (int): Number of rows saved in database.
+      rejected (int): Number of rows which are invalid or weren't saved.
+      elapsed (float): Time of loading in seconds.
+      method (str): 'load_data' or 'insert', None if nothing was loaded.
+    '''
 
-def execute_sql(statement=None):
-    try:
-        conn = connect()
-        cursor = conn.cursor()
-        cursor.execute(statement)
-        conn.commit()
-        return cursor
-    except MySQLdb.OperationalError:
-        return None
-    else:
-        conn.close()
+    def __init__(self):
+        self.loaded = 0
+        self.rejected = 0
+        self.elapsed = 0.0
+        self.method = None
 
+    def __repr__(self):
+        return '<LoadReport: loaded=%s, rejected=%s, elapsed=%.3fs>' % (
+            self.loaded, self.rejected, self.elapsed)
 
-def json_serial(obj):
-    '''JSON serializer for objects not serializable by default json code'''
+# Errors
 
-    if isinstance(obj, datetime):
-        serial = obj.isoformat()
-        return serial
-    raise TypeError("Type not serializable")
+
+class DatabaseError(Exception):
+
+    '''Error of database, it is raised instead of error of driver.
+
+    Attributes:
+      original: Exception of driver.
+    '''
+
+    def __init__(self, original=None, message=None):
+        super().__init__(message or str(original))
+        self.original = original
+
+
+class OperationalError(DatabaseError):
+
+    '''Transient error (lost connection, deadlock), reads are retried.'''
+
+
+class QueryTimeout(OperationalError):
+
+    '''Statement was cancelled after timeout.'''
+
+
+class CircuitOpenError(OperationalError):
+
+    '''Database failed too many times, statements fail fast for a while.'''
+
+
+class TransactionAborted(DatabaseError):
+
+    '''Connection of transaction was lost, transaction was rolled back.'''
+
+
+class CircuitBreaker:
+
+    '''Stops sending statements to database after consecutive failures.
+
+    After failure_threshold transient errors circuit is open and statements
+    raise CircuitOpenError. After reset_timeout one statement is let through
+    (half-open), success closes circuit, failure opens it again.
+
+    Attributes:
+      failure_threshold (int): Number of failures which opens circuit.
+      reset_timeout (float): Time in seconds of open circuit.
+      failures (int): Number of consecutive failures.
+      opened_at (float): Time of opening circuit or None if it is closed.
+    '''
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        '''Checks whether circuit is open and reset_timeout didn't pass.'''
+
+        opened_at = self.opened_at
+        return (opened_at is not None and
+                time.monotonic() - opened_at < self.reset_timeout)
+
+    def before(self):
+        '''Raises CircuitOpenError if statement shouldn't be sent.
+
+        Returns:
+          True if statement is trial of half-open circuit, then caller
+          has to call end_trial after statement.
+        '''
+        if self.opened_at is None:
+            return False
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if self.is_open() or self._trial:
+                raise CircuitOpenError(message='Circuit is open after %i '
+                                       'failures' % self.failures)
+            self._trial = True
+            return True
+
+    def end_trial(self):
+        '''Lets next statement try database if trial didn't close circuit.'''
+
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        if self.failures or self.opened_at is not None:
+            with self._lock:
+                self.failures = 0
+                self.opened_at = None
+                self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if (self.opened_at is not None or
+                    self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+
+
+class Deadline:
+
+    '''Timeout of statement executed by connection.
+
+    Attributes:
+      fired (bool): Whether statement was cancelled.
+    '''
+
+    def __init__(self, backend, conn):
+        self.backend = backend
+        self.conn = conn
+        self.fired = False
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def fire(self):
+        # Cancel can wait for database (new connection of MySQL), so it
+        # doesn't block other deadlines of watchdog
+        threading.Thread(target=self._cancel, name='db-cancel',
+                         daemon=True).start()
+
+    def finish(self):
+        '''Marks end of statement, waits for running cancel.
+
+        Cancel after end of statement is skipped, otherwise it would
+        interrupt the next statement of connection.
+        '''
+        with self._lock:
+            self._finished = True
+
+    def _cancel(self):
+        with self._lock:
+            if self._finished:
+                return
+            self.fired = True
+            try:
+                self.backend.cancel(self.conn)
+            except Exception:
+                logging.getLogger('db').exception(
+                    'Cancelling of statement failed')
+
+
+class Watchdog:
+
+    '''Thread which calls callbacks after timeouts.
+
+    One thread serves all deadlines, so timeout doesn't start new thread
+    for every statement.
+    '''
+
+    def __init__(self):
+        self._entries = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, timeout, callback):
+        '''Calls callback after timeout in seconds, returns entry for cancel.'''
+
+        entry = [time.monotonic() + timeout, next(self._counter), callback]
+        with self._condition:
+            heapq.heappush(self._entries, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='db-watchdog', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        # Cancelled entry stays in heap without callback
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._entries and self._entries[0][2] is None:
+                    heapq.heappop(self._entries)
+                if not self._entries:
+                    self._condition.wait()
+                    continue
+                delay = self._entries[0][0] - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                callback = heapq.heappop(self._entries)[2]
+            if callback is not None:
+                callback()
+
+
+watchdog = Watchdog()
+
+# Backends
+
+
+class Backend:
+
+    '''Base class of database backend.
+
+    Backend describes dialect of SQL and creates connections to database.
+    Driver of database is imported when backend connects first time.
+
+    Attributes:
+      name (str): Name of backend.
+      placeholder (str): Placeholder of params in query.
+      quote_char (str): Character for quoting names of tables and fields.
+      supports_load_data (bool): Whether LOAD DATA LOCAL INFILE is available.
+      primary_key_type (str): Definition of column id.
+      default_type (str): Type of column when field hasn't db_type.
+      params (dict): Parameters of connection.
+      statement_timeout (float): Timeout of statement in seconds or None.
+      retries (int): Number of retries of reads after transient error.
+      backoff (float): Base of exponential backoff in seconds.
+      max_backoff (float): The longest pause between retries in seconds.
+      breaker: Instance of CircuitBreaker.
+      ping_interval (float): Connection which was idle longer (seconds)
+        is checked before it is used again.
+      reconnect_after_cancel (bool): Whether connection is closed when
+        statement finished although it was cancelled (cancel can arrive
+        after the end of statement).
+    '''
+
+    name = None
+    placeholder = '%s'
+    quote_char = '"'
+    supports_load_data = False
+    reconnect_after_cancel = False
+    primary_key_type = 'INTEGER PRIMARY KEY'
+    default_type = 'VARCHAR(255)'
+
+    def __init__(self, statement_timeout=None, retries=2, backoff=0.05,
+                 max_backoff=1.0, failure_threshold=5, reset_timeout=10.0,
+                 ping_interval=30.0, **params):
+        self.params = params
+        self.ping_interval = ping_interval
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '<%s>' % self.__class__.__name__
+
+    @property
+    def driver(self):
+        '''Module of DB-API driver.'''
+
+        raise NotImplementedError
+
+    @property
+    def Error(self):
+        return self.driver.Error
+
+    def connect(self, **kwargs):
+        '''Returns new connection, kwargs update parameters of connection.'''
+
+        raise NotImplementedError
+
+    def connection(self):
+        '''Returns connection of current thread, it is used by execute_sql.
+
+        Note:
+          Server closes idle connection (MySQL wait_timeout), so connection
+          idle longer than ping_interval is pinged and opened again if it
+          was closed. Connection in transaction isn't replaced.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        now = time.monotonic()
+        if (conn is not None and
+                now - self._local.used > self.ping_interval and
+                not getattr(_local, 'transactions', 0)):
+            try:
+                self.ping(conn)
+            except self.Error:
+                self.disconnect()
+                conn = None
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        self._local.used = now
+        return conn
+
+    def ping(self, conn):
+        '''Raises error of driver if connection was closed.'''
+
+    def disconnect(self):
+        '''Closes connection of current thread.'''
+
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except self.Error:
+                pass
+
+    def execute(self, cursor, statement, params=None):
+        if params is None:
+            return cursor.execute(statement)
+        return cursor.execute(statement, params)
+
+    def execute_batch(self, cursor, statements):
+        '''Executes statements one by one and returns list of their rows.'''
+
+        results = []
+        for statement, params in statements:
+            self.execute(cursor, statement, params)
+            results.append(list(cursor.fetchall()))
+        return results
+
+    def cancel(self, conn):
+        '''Interrupts statement which is executed by connection.'''
+
+        raise NotImplementedError
+
+    @contextmanager
+    def deadline(self, conn, timeout):
+        '''Cancels statement executed in block after timeout.
+
+        Yields:
+          Instance of Deadline or None if there isn't timeout.
+        '''
+        if not timeout:
+            yield None
+            return
+        deadline = Deadline(self, conn)
+        entry = watchdog.schedule(timeout, deadline.fire)
+        try:
+            yield deadline
+        finally:
+            watchdog.cancel(entry)
+            deadline.finish()
+        if deadline.fired and self.reconnect_after_cancel:
+            # Statement finished before cancel, which can still hit
+            # the next statement
+            self.disconnect()
+
+    def is_transient(self, error):
+        '''Checks whether error of driver can disappear after retry.'''
+
+        return False
+
+    def wrap_error(self, error, deadline=None):
+        '''Returns exception of this module for error of driver.'''
+
+        if deadline is not None and deadline.fired:
+            return QueryTimeout(error)
+        if self.is_transient(error):
+            return OperationalError(error)
+        return DatabaseError(error)
+
+    def pause(self, attempt):
+        '''Sleeps before retry, exponential backoff with full jitter.'''
+
+        time.sleep(random.uniform(0, min(self.max_backoff,
+                                         self.backoff * 2 ** attempt)))
+
+    @contextmanager
+    def streaming_cursor(self):
+        '''Yields cursor which doesn't fetch all rows into memory.'''
+
+        conn = self.connect()
+        try:
+            yield conn.cursor()
+        finally:
+            conn.close()
+
+    def quote(self, name):
+        '''Returns quoted name of table or field.'''
+
+        return '%s%s%s' % (self.quote_char, name, self.quote_char)
+
+    def limit(self, count, offset=None):
+        '''Returns LIMIT statement.'''
+
+        if offset is None:
+            return 'LIMIT %i' % count
+        return 'LIMIT %i OFFSET %i' % (count, offset)
+
+    def last_insert_id(self, cursor):
+        '''Returns id of row inserted by cursor.'''
+
+        return cursor.lastrowid
+
+    def table_columns(self, table_name, using):
+        '''Returns list of columns or empty list if table doesn't exist.
+
+        Args:
+          table_name (str): Name of table.
+          using (str): Alias of this backend.
+        '''
+        raise NotImplementedError
+
+    def table_indexes(self, table_name, using):
+        '''Returns dict of indexes (without primary key) in table.
+
+        Examples:
+          {'eventmodel_person_idx': Index('person', name='eventmodel_person_idx')}
+        '''
+        raise NotImplementedError
+
+    def drop_index_sql(self, table_name, index_name):
+        return 'DROP INDEX %s' % self.quote(index_name)
+
+    def explain_sql(self, statement, format='json'):
+        '''Returns statement which explains plan of statement.'''
+
+        raise NotImplementedError
+
+    def parse_plan(self, cursor, format='json'):
+        '''Returns plan from cursor of statement from explain_sql.'''
+
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def plan_warnings(self, plan):
+        '''Returns list of problems in plan.
+
+        Examples:
+          ['full scan of eventmodel', 'filesort', 'temporary table']
+        '''
+        raise NotImplementedError
+
+    def is_missing_table(self, error):
+        '''Returns True if error of driver means that table doesn't exist.'''
+
+        return False
+
+    def _fetchall(self, statement, using):
+        '''Returns rows of schema query, no rows if table doesn't exist.'''
+
+        try:
+            cursor = execute_sql(statement, operation='schema', using=using)
+        except DatabaseError as error:
+            if self.is_missing_table(error.original):
+                return []
+            raise
+        return cursor.fetchall()
+
+
+class MySQLBackend(Backend):
+
+    '''Backend of MySQL and MariaDB with driver MySQLdb.
+
+    Note:
+      Without params backend uses con_params, so they can be changed
+      after import of this module.
+    '''
+
+    name = 'mysql'
+    placeholder = '%s'
+    quote_char = '`'
+    supports_load_data = True
+    # KILL QUERY is sent by another connection, it can arrive late
+    reconnect_after_cancel = True
+    primary_key_type = 'INT UNSIGNED AUTO_INCREMENT PRIMARY KEY'
+    # Lost connection, server gone away, too many connections, shutdown,
+    # lock wait timeout, deadlock, interrupted query
+    transient_errors = (2002, 2003, 2006, 2013, 2055, 1040, 1053, 1205,
+                        1213, 1317)
+    # Timeout in seconds of connection which sends KILL QUERY
+    cancel_timeout = 5
+
+    @property
+    def driver(self):
+        import MySQLdb
+        return MySQLdb
+
+    def connect(self, **kwargs):
+        params = dict(self.params or con_params)
+        params.update(kwargs)
+        return self.driver.connect(**params)
+
+    def ping(self, conn):
+        conn.ping()
+
+    def execute_batch(self, cursor, statements):
+        # One multi-statement query, MySQLdb connects with multi_statements
+        # and every statement returns own result set
+        if len(statements) == 1:
+            return super().execute_batch(cursor, statements)
+        params = [value for _, values in statements for value in values or ()]
+        self.execute(cursor, ';\n'.join(statement for statement, _ in statements),
+                     params or None)
+        results = [list(cursor.fetchall())]
+        while cursor.nextset():
+            results.append(list(cursor.fetchall()))
+        return results
+
+    def cancel(self, conn):
+        killer = self.connect(connect_timeout=self.cancel_timeout,
+                              read_timeout=self.cancel_timeout,
+                              write_timeout=self.cancel_timeout)
+        try:
+            killer.cursor().execute('KILL QUERY %i' % conn.thread_id())
+        finally:
+            killer.close()
+
+    def is_transient(self, error):
+        return (isinstance(error, self.driver.OperationalError) and
+                bool(error.args) and error.args[0] in self.transient_errors)
+
+    def is_missing_table(self, error):
+        # Table doesn't exist
+        return (isinstance(error, self.driver.ProgrammingError) and
+                bool(error.args) and error.args[0] == 1146)
+
+    @contextmanager
+    def streaming_cursor(self):
+        import MySQLdb.cursors
+        conn = self.connect()
+        try:
+            yield conn.cursor(MySQLdb.cursors.SSCursor)
+        finally:
+            conn.close()
+
+    def table_columns(self, table_name, using):
+        rows = self._fetchall('SHOW COLUMNS FROM %s' % self.quote(table_name),
+                              using)
+        return [row[0] for row in rows]
+
+    def table_indexes(self, table_name, using):
+        # Rows: Table, Non_unique, Key_name, Seq_in_index, Column_name, ...
+        rows = self._fetchall('SHOW INDEX FROM %s' % self.quote(table_name),
+                              using)
+        columns = defaultdict(list)
+        unique = {}
+        for row in sorted(rows, key=lambda row: (row[2], row[3])):
+            if row[2] == 'PRIMARY':
+                continue
+            columns[row[2]].append(row[4])
+            unique[row[2]] = not int(row[1])
+        return dict((name, Index(*fields, unique=unique[name], name=name))
+                    for name, fields in columns.items())
+
+    def drop_index_sql(self, table_name, index_name):
+        return 'DROP INDEX %s ON %s' % (self.quote(index_name),
+                                        self.quote(table_name))
+
+    def explain_sql(self, statement, format='json'):
+        if format == 'json':
+            return 'EXPLAIN FORMAT=JSON ' + statement
+        return 'EXPLAIN ' + statement
+
+    def parse_plan(self, cursor, format='json'):
+        if format == 'json':
+            (plan, ) = cursor.fetchone()
+            return json.loads(plan)
+        return super().parse_plan(cursor, format)
+
+    def plan_warnings(self, plan):
+        warnings = []
+
+        def walk(node):
+            if isinstance(node, list):
+                for value in node:
+                    walk(value)
+            elif isinstance(node, dict):
+                # Nodes of json plan or rows of traditional plan
+                extra = node.get('Extra') or ''
+                if 'ALL' in (node.get('access_type'), node.get('type')):
+                    warnings.append('full scan of %s' % (
+                        node.get('table_name') or node.get('table')))
+                if node.get('using_filesort') or 'Using filesort' in extra:
+                    warnings.append('filesort')
+                if (node.get('using_temporary_table') or
+                        'Using temporary' in extra):
+                    warnings.append('temporary table')
+                for value in node.values():
+                    walk(value)
+        walk(plan)
+        return warnings
+
+
+class SQLiteBackend(Backend):
+
+    '''Embedded backend with sqlite3 from standard library.
+
+    Note:
+      All threads use one connection with in-memory database, otherwise
+      every thread has own connection.
+
+    Examples:
+      db.use_backend('sqlite', database='events.sqlite')
+    '''
+
+    name = 'sqlite'
+    placeholder = '?'
+    quote_char = '"'
+
+    def __init__(self, database=':memory:', **params):
+        super().__init__(database=database, **params)
+        sqlite3 = self.driver
+        # Values of DATETIME columns are returned as datetime like in MySQL
+        sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+        sqlite3.register_converter('DATETIME', parse_datetime)
+        self._shared = None
+        if database == ':memory:':
+            self._shared = self.connect()
+
+    @property
+    def driver(self):
+        import sqlite3
+        return sqlite3
+
+    def connect(self, **kwargs):
+        params = dict(self.params, check_same_thread=False,
+                      detect_types=self.driver.PARSE_DECLTYPES)
+        params.update(kwargs)
+        return self.driver.connect(**params)
+
+    def connection(self):
+        if self._shared is not None:
+            return self._shared
+        return super().connection()
+
+    def disconnect(self):
+        # In-memory database is removed with the last connection
+        if self._shared is None:
+            super().disconnect()
+
+    def cancel(self, conn):
+        conn.interrupt()
+
+    def is_transient(self, error):
+        message = str(error).lower()
+        return (isinstance(error, self.driver.OperationalError) and
+                ('locked' in message or 'busy' in message or
+                 'unable to open' in message or 'disk i/o' in message))
+
+    @contextmanager
+    def streaming_cursor(self):
+        # Cursor of sqlite3 fetches rows when they are read
+        yield self.connection().cursor()
+
+    def table_columns(self, table_name, using):
+        # Rows: cid, name, type, notnull, dflt_value, pk
+        rows = self._fetchall('PRAGMA table_info(%s)' % self.quote(table_name),
+                              using)
+        return [row[1] for row in rows]
+
+    def table_indexes(self, table_name, using):
+        # Rows: seq, name, unique, origin, partial
+        rows = self._fetchall('PRAGMA index_list(%s)' % self.quote(table_name),
+                              using)
+        indexes = {}
+        for row in rows:
+            if row[3] == 'pk':
+                continue
+            # Rows: seqno, cid, name
+            info = self._fetchall('PRAGMA index_info(%s)' % self.quote(row[1]),
+                                  using)
+            fields = [column for _, _, column in sorted(info)]
+            indexes[row[1]] = Index(*fields, unique=bool(row[2]), name=row[1])
+        return indexes
+
+    def explain_sql(self, statement, format='json'):
+        return 'EXPLAIN QUERY PLAN ' + statement
+
+    def plan_warnings(self, plan):
+        # Rows: id, parent, notused, detail, e.g. 'SCAN eventmodel'
+        warnings = []
+        for row in plan:
+            detail = row['detail']
+            words = detail.split()
+            if words[0] == 'SCAN' and 'USING' not in words:
+                table = words[2] if words[1] == 'TABLE' else words[1]
+                warnings.append('full scan of %s' % table)
+            elif detail.startswith('USE TEMP B-TREE FOR ORDER BY'):
+                warnings.append('filesort')
+            elif detail.startswith('USE TEMP B-TREE'):
+                warnings.append('temporary table')
+        return warnings
+
+
+backend_classes = {
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend,
+}
+
+backends = {}
+
+
+def use_backend(backend='mysql', alias='default', **params):
+    '''Selects backend of database and returns it.
+
+    Args:
+      backend: 'mysql', 'sqlite' or instance of Backend.
+      alias (str, optional): Name of database. Defaults to 'default'.
+      params: Parameters of connection and statement_timeout, retries,
+        backoff, max_backoff, failure_threshold, reset_timeout,
+        ping_interval of Backend.
+
+    Examples:
+      db.use_backend('sqlite', database=':memory:')
+      db.use_backend('mysql', db='events', user='orm', passwd='secret')
+      db.use_backend('mysql', alias='replica1', host='10.0.0.2',
+                     statement_timeout=2.0, retries=3)
+    '''
+    if isinstance(backend, str):
+        backend = backend_classes[backend](**params)
+    backends[alias] = backend
+    return backend
+
+
+def get_backend(alias='default'):
+    '''Returns backend of database, by default MySQL with con_params.'''
+
+    try:
+        return backends[alias]
+    except KeyError:
+        if alias != 'default':
+            raise
+        return backends.setdefault(alias, MySQLBackend())
+
+
+class Router:
+
+    '''Routes reads to replicas and other queries to primary database.
+
+    Reads are queries with operation 'select', 'get' and 'count' (also
+    json of query). Inside transaction and after write inside request_scope
+    reads go to primary, so they see own writes.
+
+    Attributes:
+      replicas (list): Aliases of replica backends.
+      strategy (str): 'round_robin' or 'least_latency'.
+      decay (float): Weight of the last query in average latency.
+      latency (dict): Average latency of replica in seconds.
+    '''
+
+    primary = 'default'
+    read_operations = ('select', 'get', 'count', 'explain', 'batch')
+
+    def __init__(self, replicas=(), strategy='round_robin', decay=0.2):
+        self.configure(replicas, strategy, decay)
+
+    def configure(self, replicas=(), strategy='round_robin', decay=0.2):
+        if strategy not in ('round_robin', 'least_latency'):
+            raise ValueError('Unknown strategy: %s' % strategy)
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.decay = decay
+        self.latency = dict((alias, 0.0) for alias in self.replicas)
+        self._cycle = itertools.cycle(self.replicas)
+        self._lock = threading.Lock()
+
+    def alias(self, using=None):
+        '''Returns alias of backend with dialect for using.'''
+
+        if using in (None, 'primary', 'replica'):
+            return self.primary
+        return using
+
+    def route(self, operation, using=None):
+        '''Returns alias of database for query.
+
+        Args:
+          operation (str): Type of query.
+          using (str, optional): 'primary', 'replica' or alias of backend.
+        '''
+        if using == 'primary':
+            return self.primary
+        if using == 'replica':
+            return self.replica() or self.primary
+        if using is not None:
+            return using
+        if operation in self.read_operations:
+            if self.replicas and not pinned_to_primary():
+                return self.replica() or self.primary
+            return self.primary
+        # Reads after write in request scope go to primary
+        if getattr(_local, 'sticky', None) is False:
+            _local.sticky = True
+        return self.primary
+
+    def replica(self):
+        '''Returns alias of replica or None if there aren't replicas.'''
+
+        # Replicas with open circuit are skipped
+        replicas = [alias for alias in self.replicas
+                    if not get_backend(alias).breaker.is_open()]
+        if not replicas:
+            return None
+        if self.strategy == 'least_latency':
+            return min(replicas, key=lambda alias: self.latency[alias])
+        with self._lock:
+            for alias in self._cycle:
+                if alias in replicas:
+                    return alias
+
+    def __call__(self, event):
+        '''Listener of after_execute which measures latency of replicas.'''
+
+        if event.using not in self.latency:
+            return
+        duration = event.duration
+        if event.error is not None:
+            # Replica with errors is used only when others are slower
+            duration = max(duration, 1.0)
+        with self._lock:
+            self.latency[event.using] += self.decay * (
+                duration - self.latency[event.using])
+
+
+def use_replicas(*aliases, strategy='round_robin'):
+    '''Sends reads to replicas with aliases registered by use_backend.
+
+    Examples:
+      db.use_backend('mysql', alias='replica1', host='10.0.0.2', ...)
+      db.use_backend('mysql', alias='replica2', host='10.0.0.3', ...)
+      db.use_replicas('replica1', 'replica2', strategy='least_latency')
+    '''
+    router.configure(aliases, strategy)
+
+
+def pinned_to_primary():
+    '''Checks whether reads of current thread should go to primary.'''
+
+    return bool(getattr(_local, 'transactions', 0) or
+                getattr(_local, 'sticky', None))
+
+
+@contextmanager
+def transaction():
+    '''Executes queries of block in one transaction on primary database.
+
+    Note:
+      Commits on exit, rollbacks on exception. Nested blocks are part of
+      the outer transaction. Reads in block go to primary.
+
+    Raises:
+      TransactionAborted: Connection was lost (e.g. after OperationalError
+        caught in block), so later statements and commit fail.
+    '''
+    depth = getattr(_local, 'transactions', 0)
+    backend = get_backend(router.primary)
+    if depth == 0:
+        _local.transaction_conn = backend.connection()
+    _local.transactions = depth + 1
+    try:
+        yield
+        if depth == 0:
+            conn = backend.connection()
+            if conn is not _local.transaction_conn:
+                raise TransactionAborted(message='Connection was lost, '
+                                         'transaction was rolled back')
+            conn.commit()
+    except BaseException:
+        if depth == 0:
+            backend.connection().rollback()
+        raise
+    finally:
+        _local.transactions = depth
+        if depth == 0:
+            del _local.transaction_conn
+
+
+@contextmanager
+def request_scope():
+    '''After the first write in block reads go to primary (read-your-writes).
+
+    Examples:
+      with db.request_scope():
+          EventModel.objects.create(text='Beer', person='@all', date=now)
+          EventModel.objects.all().json()  # from primary
+    '''
+    previous = getattr(_local, 'sticky', None)
+    _local.sticky = False
+    try:
+        yield
+    finally:
+        _local.sticky = previous
+
+
+class Deferred:
+
+    '''Result of query deferred by batch, it is available after batch.'''
+
+    def __init__(self, combine, parts):
+        self._combine = combine
+        self._results = [None] * parts
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        '''Returns result of query or raises its error.'''
+
+        if not self._done:
+            raise RuntimeError('Result of deferred query is available '
+                               'after end of batch')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _resolve(self, error=None):
+        self._done = True
+        if error is not None:
+            self._error = error
+            return
+        try:
+            self._value = self._combine(self._results)
+        except Exception as error:
+            self._error = error
+
+
+class Batch:
+
+    '''Reads deferred in block of batch, they are grouped by database.
+
+    Attributes:
+      statements (dict): Alias of database -> list of (statement, params,
+        deferred, position of statement in deferred).
+    '''
+
+    def __init__(self):
+        self.statements = defaultdict(list)
+        self.deferred = []
+        self._routes = {}
+
+    def defer(self, parts, combine, model=None, operation='select'):
+        '''Adds statements of one query and returns Deferred.
+
+        Args:
+          parts (list): Tuples of using, statement and params, e.g. one
+            for every shard.
+          combine: Function which gets list of rows for every part and
+            returns result of query.
+          model (optional): Class of model.
+          operation (str, optional): Type of query for router.
+        '''
+        deferred = Deferred(combine, len(parts))
+        for position, (using, statement, params) in enumerate(parts):
+            # All reads of batch go to one replica
+            key = (using, pinned_to_primary())
+            if key not in self._routes:
+                self._routes[key] = router.route(operation, using)
+            self.statements[self._routes[key]].append(
+                (statement, params, deferred, position))
+        self.deferred.append(deferred)
+        return deferred
+
+    def flush(self):
+        '''Executes statements, one round trip for every database.'''
+
+        statements, self.statements = self.statements, defaultdict(list)
+        deferred, self.deferred = self.deferred, []
+        if not statements:
+            return
+
+        def run(alias):
+            return execute_batch([(statement, params) for statement, params,
+                                  _, _ in statements[alias]], using=alias)
+        try:
+            results = fan_out(list(statements), run)
+        except DatabaseError as error:
+            for query in deferred:
+                query._resolve(error)
+            raise
+        for alias, rowsets in zip(statements, results):
+            for (_, _, query, position), rows in zip(statements[alias],
+                                                     rowsets):
+                query._results[position] = rows
+        for query in deferred:
+            query._resolve()
+
+
+@contextmanager
+def batch():
+    '''Defers reads of block and sends them together when block ends.
+
+    Inside block count(), get() and calling of query return Deferred,
+    their statements are sent in one round trip to every database
+    (multi-statement query on MySQL). Nested blocks are part of the outer
+    batch, writes aren't deferred. Iteration, len(), repr(), get_or_create()
+    and update() need result, so they run immediately.
+
+    Examples:
+      with db.batch():
+          total = EventModel.objects.count()
+          events = EventModel.objects.filter(person='@all')[0:20]()
+          event = EventModel.objects.get(id=5)
+      total.result(), events.result(), event.result()
+    '''
+    current = current_batch()
+    if current is not None:
+        yield current
+        return
+    current = _local.batch = Batch()
+    try:
+        yield current
+    finally:
+        _local.batch = None
+    current.flush()
+
+
+def current_batch():
+    '''Returns Batch of current thread or None outside of batch.'''
+
+    return getattr(_local, 'batch', None)
+
+# Instrumentation
+
+
+class QueryEvent:
+
+    '''Describes statement which is sent to database.
+
+    Instance is passed to listeners of before_execute (without duration,
+    rowcount and error) and after_execute.
+
+    Attributes:
+      statement (str): SQL query.
+      params: Params of query or None.
+      model: Class of model which sends query or None.
+      operation (str): Type of query ('select', 'get', 'count', 'insert',
+        'update', 'delete', 'load') or None.
+      using (str): Alias of database.
+      duration (float): Time of execution in seconds.
+      rowcount (int): Number of rows returned or changed by query.
+      error: Exception raised by database or None.
+    '''
+
+    def __init__(self, statement, params=None, model=None, operation=None,
+                 using=None):
+        self.statement = statement
+        self.params = params
+        self.model = model
+        self.operation = operation
+        self.using = using
+        self.duration = None
+        self.rowcount = None
+        self.error = None
+
+    def __repr__(self):
+        return '<QueryEvent: %s %s>' % (self.operation, self.statement)
+
+    @property
+    def model_name(self):
+        return getattr(self.model, '__name__', None)
+
+
+class SlowQueryLog:
+
+    '''Listener of after_execute which logs queries slower than threshold.
+
+    Attributes:
+      threshold (float): Minimal duration in seconds of logged query.
+      logger: Logger for slow queries. Defaults to logger 'db.slow_query'.
+
+    Examples:
+      db.add_listener('after_execute', db.SlowQueryLog(threshold=0.5))
+    '''
+
+    def __init__(self, threshold=1.0, logger=None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('db.slow_query')
+
+    def __call__(self, event):
+        if event.duration >= self.threshold:
+            self.logger.warning('Slow query (%.3fs) %s.%s: %s %r',
+                                event.duration, event.model_name,
+                                event.operation, event.statement,
+                                event.params)
+
+
+class PlanCapture:
+
+    '''Listener of after_execute which logs plans of slow SELECT queries.
+
+    Plan is captured once for every shape of statement (see normalize_sql)
+    and it is logged with model, call site and warnings about full scans,
+    filesort and temporary tables.
+
+    Attributes:
+      threshold (float): Minimal duration in seconds of explained query.
+      logger: Logger for plans. Defaults to logger 'db.plan'.
+      max_plans (int): The most number of captured plans.
+      plans (dict): Shape of statement -> dict with plan, warnings, model,
+        call site and duration.
+
+    Examples:
+      db.add_listener('after_execute', db.PlanCapture(threshold=0.5))
+    '''
+
+    # Batches and schema queries aren't single SELECT statements
+    skipped_operations = ('explain', 'batch', 'load', 'schema')
+
+    def __init__(self, threshold=1.0, logger=None, max_plans=1000):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('db.plan')
+        self.max_plans = max_plans
+        self.plans = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if (event.duration < self.threshold or event.error is not None or
+                event.operation in self.skipped_operations or
+                not event.statement or
+                event.statement.lstrip()[:6].upper() != 'SELECT'):
+            return
+        shape = normalize_sql(event.statement)
+        with self._lock:
+            if shape in self.plans or len(self.plans) >= self.max_plans:
+                return
+            # Other threads don't explain this same shape
+            self.plans[shape] = None
+        try:
+            plan = explain(event.statement, event.params, model=event.model,
+                           using=event.using)
+        except DatabaseError as error:
+            self.logger.warning('Plan of %s.%s failed: %s', event.model_name,
+                                event.operation, error)
+            return
+        captured = {
+            'plan': plan,
+            'warnings': get_backend(event.using).plan_warnings(plan),
+            'model': event.model_name,
+            'call_site': call_site(),
+            'duration': event.duration,
+        }
+        self.plans[shape] = captured
+        self.logger.warning('Slow query (%.3fs) %s.%s at %s: %s\n'
+                            'Warnings: %s\nPlan: %s', event.duration,
+                            event.model_name, event.operation,
+                            captured['call_site'], event.statement,
+                            ', '.join(captured['warnings']) or 'none',
+                            json.dumps(plan, default=json_serial))
+
+
+class QueryStats:
+
+    '''Listener of after_execute which counts queries per model and operation.
+
+    Attributes:
+      buckets (tuple): Upper bounds in seconds of duration histogram.
+
+    Examples:
+      db.stats.snapshot()
+      {'HelperModel': {'get': {'count': 2, 'errors': 0, 'rows': 2,
+                               'total_time': 0.004,
+                               'histogram': {0.001: 0, ..., inf: 2}}}}
+    '''
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, event):
+        key = (event.model_name, event.operation)
+        with self._lock:
+            counters = self._counters.get(key)
+            if counters is None:
+                counters = self._counters[key] = {
+                    'count': 0, 'errors': 0, 'rows': 0, 'total_time': 0.0,
+                    'histogram': [0] * len(self.buckets)}
+            counters['count'] += 1
+            counters['total_time'] += event.duration
+            if event.error is not None:
+                counters['errors'] += 1
+            if event.rowcount is not None and event.rowcount > 0:
+                counters['rows'] += event.rowcount
+            for index, bound in enumerate(self.buckets):
+                if event.duration <= bound:
+                    counters['histogram'][index] += 1
+                    break
+
+    def reset(self):
+        '''Removes all counters.'''
+
+        with self._lock:
+            self._counters = {}
+
+    def snapshot(self):
+        '''Returns dict of counters grouped by name of model and operation.
+
+        Note:
+          Histogram is cumulative, every bucket counts queries with
+          duration less than or equal its bound.
+        '''
+        result = defaultdict(dict)
+        with self._lock:
+            for (model, operation), counters in self._counters.items():
+                cumulative = 0
+                histogram = {}
+                for bound, number in zip(self.buckets, counters['histogram']):
+                    cumulative += number
+                    histogram[bound] = cumulative
+                result[model][operation] = dict(counters, histogram=histogram)
+        return dict(result)
+
+
+class QueryBudgetExceeded(Exception):
+
+    '''Raised when scope of query_budget executes too many queries.'''
+
+
+class RepeatedQueryWarning(UserWarning):
+
+    '''Warns about query repeated in scope of query_budget (N+1 queries).'''
+
+
+class QueryBudget:
+
+    '''Scope which counts queries executed in current thread.
+
+    Queries are grouped by shape (SQL without values) with call sites.
+    Use query_budget for creating it.
+
+    Attributes:
+      max_queries (int): Maximum number of queries in scope or None.
+      max_repeats (int): Maximum number of queries with this same shape
+        or None.
+      action (str): 'raise', 'warn' or 'log' when budget is exceeded.
+      sample_rate (float): Fraction of scopes which are checked.
+      queries (int): Number of executed queries.
+      shapes (dict): Shape of query mapped on list of call sites.
+      active (bool): False if scope wasn't sampled.
+    '''
+
+    logger = logging.getLogger('db.query_budget')
+
+    def __init__(self, max_queries=None, max_repeats=None, action='raise',
+                 sample_rate=1.0):
+        if action not in ('raise', 'warn', 'log'):
+            raise ValueError('Unknown action: %s' % action)
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.action = action
+        self.sample_rate = sample_rate
+        self.queries = 0
+        self.shapes = {}
+        self.active = False
+        self._reported = set()
+        # Worker threads of fan_out record into budget of calling thread
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.active = random.random() < self.sample_rate
+        if self.active:
+            _budgets().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.active:
+            _budgets().remove(self)
+        return False
+
+    def record(self, event):
+        '''Counts query and checks limits.'''
+
+        shape = normalize_sql(event.statement)
+        site = call_site()
+        with self._lock:
+            sites = self.shapes.setdefault(shape, [])
+            sites.append(site)
+            self.queries += 1
+            queries, repeats = self.queries, len(sites)
+            formatted = self._format_sites(sites)
+        if self.max_queries is not None and queries > self.max_queries:
+            self._exceeded('queries', 'Executed %i queries, budget is %i'
+                           % (queries, self.max_queries))
+        if self.max_repeats is not None and repeats > self.max_repeats:
+            self._exceeded(shape, 'Query repeated %i times (N+1?): %s\n%s'
+                           % (repeats, shape, formatted))
+
+    def repeated(self):
+        '''Returns dict of shapes executed more than once with call sites.'''
+
+        return dict((shape, sites) for shape, sites in self.shapes.items()
+                    if len(sites) > 1)
+
+    def report(self):
+        '''Returns description of repeated queries.'''
+
+        lines = ['%i queries, %i shapes' % (self.queries, len(self.shapes))]
+        for shape, sites in sorted(self.repeated().items(),
+                                   key=lambda item: -len(item[1])):
+            lines.append('%i x %s' % (len(sites), shape))
+            lines.append(self._format_sites(sites))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _format_sites(sites):
+        counted = defaultdict(int)
+        for site in sites:
+            counted[site] += 1
+        return '\n'.join('  %i x %s' % (number, site)
+                         for site, number in counted.items())
+
+    def _exceeded(self, key, message):
+        if self.action == 'raise':
+            raise QueryBudgetExceeded(message)
+        # Warns only once about every limit
+        with self._lock:
+            if key in self._reported:
+                return
+            self._reported.add(key)
+        if self.action == 'warn':
+            warnings.warn(message, RepeatedQueryWarning, stacklevel=2)
+        else:
+            self.logger.warning(message)
+
+
+def query_budget(max_queries=None, max_repeats=None, action='raise',
+                 sample_rate=1.0):
+    '''Returns context manager which checks queries executed in block.
+
+    Args:
+      max_queries (int, optional): Maximum number of queries.
+      max_repeats (int, optional): Maximum number of queries with this same
+        shape, detects N+1 queries.
+      action (str, optional): 'raise' QueryBudgetExceeded, 'warn' with
+        RepeatedQueryWarning or 'log' to logger 'db.query_budget'.
+      sample_rate (float, optional): Fraction of checked scopes,
+        e.g. 0.01 for production.
+
+    Examples:
+      with db.query_budget(max_queries=10, max_repeats=2) as budget:
+          for event in EventModel.objects.all():
+              Person.objects.get(id=event.person)
+    '''
+    return QueryBudget(max_queries, max_repeats, action, sample_rate)
+
+
+_local = threading.local()
+
+
+def _budgets():
+    '''Returns list of active budgets in current thread.'''
+
+    try:
+        return _local.budgets
+    except AttributeError:
+        _local.budgets = []
+        return _local.budgets
+
+
+def check_budgets(event):
+    '''Listener of after_execute which passes event to active budgets.'''
+
+    # Plans are captured by diagnostics, not by code under budget
+    if event.operation == 'explain':
+        return
+    for budget in list(_budgets()):
+        budget.record(event)
+
+
+stats = QueryStats()
+
+router = Router()
+
+listeners = {
+    'before_execute': [],
+    'after_execute': [stats, check_budgets, router],
+}
+
+
+def add_listener(event, listener):
+    '''Registers callable which takes instance of QueryEvent.
+
+    Args:
+      event (str): 'before_execute' or 'after_execute'.
+      listener (callable): Listener of event.
+    '''
+    listeners[event].append(listener)
+    return listener
+
+
+def remove_listener(event, listener):
+    '''Unregisters listener of event.'''
+
+    listeners[event].remove(listener)
+
+
+def before_execute(listener):
+    '''Decorator which registers listener of before_execute.'''
+
+    return add_listener('before_execute', listener)
+
+
+def after_execute(listener):
+    '''Decorator which registers listener of after_execute.'''
+
+    return add_listener('after_execute', listener)
+
+
+@contextmanager
+def instrumented(statement, params=None, model=None, operation=None,
+                 using=None):
+    '''Notifies listeners about statement executed in block.
+
+    Yields:
+      Instance of QueryEvent, block should sets rowcount.
+    '''
+    event = QueryEvent(statement, params, model, operation, using)
+    for listener in listeners['before_execute']:
+        listener(event)
+    start = time.perf_counter()
+    try:
+        yield event
+    except Exception as error:
+        event.error = error
+        raise
+    finally:
+        event.duration = time.perf_counter() - start
+        for listener in listeners['after_execute']:
+            listener(event)
+
+# Helpers
+
+
+def connect(**kwargs):
+    return get_backend().connect(**kwargs)
+
+
+def make_migration(*models, drop_indexes=False, using=None):
+    '''Compares models with database and returns list of SQL queries.
+
+    Queries create missing tables, columns and indexes. Index is missing
+    when table hasn't index with this same fields and uniqueness.
+
+    Args:
+      models: Classes of models.
+      drop_indexes (bool, optional): If true then removes indexes which
+        aren't declared in models.
+      using (str, optional): Alias of database. Defaults to primary.
+
+    Examples:
+      for sql_query in db.make_migration(EventModel, PersonModel):
+          print(sql_query + ';')
+    '''
+    using = router.alias(using)
+    backend = get_backend(using)
+    statements = []
+    for model in models:
+        table_name = model.__name__.lower()
+        columns = backend.table_columns(table_name, using)
+        if not columns:
+            statements.extend(model.schema_sql())
+            continue
+        for field in model.Fields:
+            if field not in columns:
+                statements.append('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    model._table_name(), backend.quote(field),
+                    model._column_sql(field)))
+        statements.extend(_index_migration(model, backend, using,
+                                           drop_indexes))
+    return statements
+
+
+def _index_migration(model, backend, using, drop_indexes=False):
+    '''Returns queries which create missing indexes of existing table.'''
+
+    table_name = model.__name__.lower()
+    existing = backend.table_indexes(table_name, using)
+    existing_keys = dict(((index.columns, index.unique), name)
+                         for name, index in existing.items())
+    declared_keys = set()
+    statements = []
+    for index in model.Indexes:
+        key = (index.columns, index.unique)
+        declared_keys.add(key)
+        if key not in existing_keys:
+            statements.append(model._create_index_sql(index))
+    if drop_indexes:
+        for key, name in sorted(existing_keys.items(),
+                                key=lambda item: item[1]):
+            if key not in declared_keys:
+                statements.append(backend.drop_index_sql(table_name, name))
+    return statements
+
+
+def explain(statement, params=None, model=None, using=None, format='json'):
+    '''Returns plan of statement, see Query.explain.'''
+
+    using = router.route('explain', using)
+    backend = get_backend(using)
+    cursor = execute_sql(backend.explain_sql(statement, format), params,
+                         model=model, operation='explain', using=using)
+    return backend.parse_plan(cursor, format)
+
+
+def execute_sql(statement=None, params=None, model=None, operation=None,
+                using=None, timeout=None):
+    '''Executes statement and returns cursor.
+
+    Reads (outside of transaction) are retried after transient errors
+    with exponential backoff, connection is opened again.
+
+    Args:
+      statement (str): SQL query.
+      params (optional): Params of query.
+      model (optional): Class of model, it is passed to listeners.
+      operation (str, optional): Type of query, it is passed to listeners
+        and router sends reads to replicas.
+      using (str, optional): 'primary', 'replica' or alias of backend.
+        Defaults to None, then router selects database.
+      timeout (float, optional): Timeout in seconds. Defaults to None,
+        then statement_timeout of backend is used.
+
+    Returns:
+      Cursor.
+
+    Raises:
+      QueryTimeout: Statement was cancelled after timeout.
+      CircuitOpenError: Database failed too many times.
+      OperationalError: Transient error, e.g. lost connection.
+      DatabaseError: Other errors of database.
+    '''
+    using = router.route(operation, using)
+    backend = get_backend(using)
+
+    def run(cursor):
+        backend.execute(cursor, statement, params)
+        return cursor
+    return _execute(backend, run, statement, params, model, operation, using,
+                    timeout)
+
+
+def execute_batch(statements, using=None, timeout=None):
+    '''Executes reads in one round trip and returns list of rows for each.
+
+    Args:
+      statements (list): Pairs of SQL query and params (or None).
+      using (str, optional): 'primary', 'replica' or alias of backend.
+      timeout (float, optional): Timeout of all statements in seconds.
+
+    Returns:
+      List of lists of rows in the order of statements.
+
+    Examples:
+      db.execute_batch([('SELECT COUNT(*) FROM `model`', None),
+                        ('SELECT `id` FROM `model` WHERE `id` = %s', [5])])
+      [[(2, )], [(5, )]]
+    '''
+    using = router.route('batch', using)
+    backend = get_backend(using)
+    statement = ';\n'.join(statement for statement, _ in statements)
+    params = [value for _, values in statements for value in values or ()]
+
+    def run(cursor):
+        return backend.execute_batch(cursor, statements)
+    return _execute(backend, run, statement, params or None, None, 'batch',
+                    using, timeout)
+
+
+def _execute(backend, run, statement, params, model, operation, using,
+             timeout):
+    '''Calls run with cursor and retries reads after transient errors.'''
+
+    in_transaction = bool(using == router.primary and
+                          getattr(_local, 'transactions', 0))
+    # Statements after lost connection would be committed without the
+    # beginning of transaction
+    if in_transaction and backend.connection() is not _local.transaction_conn:
+        raise TransactionAborted(message='Connection was lost, transaction '
+                                 'was rolled back')
+    retries = 0
+    if operation in router.read_operations and not in_transaction:
+        retries = backend.retries
+    attempt = 0
+    while True:
+        try:
+            return _attempt(backend, run, statement, params, model,
+                            operation, using,
+                            timeout or backend.statement_timeout,
+                            in_transaction)
+        except (QueryTimeout, CircuitOpenError):
+            raise
+        except OperationalError:
+            if attempt >= retries:
+                raise
+            backend.pause(attempt)
+            attempt += 1
+
+
+def _attempt(backend, run, statement, params, model, operation, using,
+             timeout, in_transaction):
+    with instrumented(statement, params, model, operation, using) as event:
+        trial = backend.breaker.before()
+        deadline = None
+        try:
+            conn = backend.connection()
+            cursor = conn.cursor()
+            with backend.deadline(conn, timeout) as deadline:
+                result = run(cursor)
+                if not in_transaction:
+                    conn.commit()
+        except backend.Error as error:
+            wrapped = backend.wrap_error(error, deadline)
+            if isinstance(wrapped, OperationalError):
+                backend.breaker.failure()
+                # Connection can be lost, next query connects again
+                backend.disconnect()
+            else:
+                # Database answered, e.g. table doesn't exist
+                backend.breaker.success()
+            raise wrapped from error
+        finally:
+            if trial:
+                backend.breaker.end_trial()
+        backend.breaker.success()
+        event.rowcount = cursor.rowcount
+        return result
+
+
+def json_serial(obj):
+    '''JSON serializer for objects not serializable by default json code'''
+
+    if isinstance(obj, datetime):
+        serial = obj.isoformat()
+        return serial
+    raise TypeError("Type not serializable")
+
+
+def read_records(path, format='csv', mapping=None):
+    '''Reads file and yields dicts of fields with value.
+
+    Note:
+      Broken records (bad json, wrong number of columns in csv) are
+      yielded as None. Empty csv values are None.
+
+    Args:
+      path (str): Path to the file.
+      format (str): 'csv' or 'ndjson'.
+      mapping (dict, optional): Names of columns mapped on names of fields.
+    '''
+    mapping = mapping or {}
+    if format == 'csv':
+        with open(path, newline='', encoding='utf-8') as source:
+            for row in csv.DictReader(source):
+                if None in row or None in row.values():
+                    yield None
+                    continue
+                yield dict((mapping.get(key, key), value or None)
+                           for key, value in row.items())
+    elif format == 'ndjson':
+        with open(path, encoding='utf-8') as source:
+            for line in source:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    yield None
+                    continue
+                if not isinstance(row, dict):
+                    yield None
+                    continue
+                yield dict((mapping.get(key, key), value)
+                           for key, value in row.items())
+    else:
+        raise ValueError('Unknown format of file: %s' % format)
+
+
+fan_out_workers = 8
+
+_fan_out_executor = None
+
+
+def fan_out(aliases, func):
+    '''Calls func with every alias concurrently and returns list of results.
+
+    Note:
+      Query budgets of current thread count queries of worker threads,
+      which are reported with call site of fan_out.
+    '''
+    global _fan_out_executor
+    if len(aliases) == 1:
+        return [func(aliases[0])]
+    if _fan_out_executor is None:
+        _fan_out_executor = ThreadPoolExecutor(
+            fan_out_workers, thread_name_prefix='db-fan-out')
+    budgets = _budgets()
+    if not budgets:
+        return list(_fan_out_executor.map(func, aliases))
+    # Call site of workers is taken only for budgets, stack is expensive
+    site = call_site()
+
+    def call(alias):
+        _local.budgets = budgets
+        _local.call_site = site
+        try:
+            return func(alias)
+        finally:
+            del _local.budgets
+            del _local.call_site
+    return list(_fan_out_executor.map(call, aliases))
+
+
+class SortKey:
+
+    '''Compares values like ORDER BY, NULL is the lowest value.'''
+
+    __slots__ = ('value', 'descending')
+
+    def __init__(self, value, descending=False):
+        self.value = value
+        self.descending = descending
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        first, second = self.value, other.value
+        if self.descending:
+            first, second = second, first
+        if first is None:
+            return second is not None
+        if second is None:
+            return False
+        return first < second
+
+
+def merge_sorted(results, order, fields):
+    '''K-way merge of lists of rows sorted by order.
+
+    Args:
+      results (list): Lists of rows from shards.
+      order (tuple): Pairs of field and direction like in Query._order_by.
+      fields (tuple): Names of fields in the order of columns.
+    '''
+    positions = [(fields.index(field), direction == 'DESC')
+                 for field, direction in order]
+
+    def key(row):
+        return tuple(SortKey(row[position], descending)
+                     for position, descending in positions)
+    return heapq.merge(*results, key=key)
+
+
+def parse_datetime(value):
+    '''Converts DATETIME value from SQLite to datetime'''
+
+    value = value.decode()
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def normalize_sql(statement):
+    '''Returns shape of query, values are replaced with ?.
+
+    Examples:
+      "SELECT id FROM model WHERE id = '5' AND list_id IN (1, 2)"
+      'SELECT id FROM model WHERE id = ? AND list_id IN (...)'
+    '''
+    shape = _string_literal.sub('?', statement)
+    shape = _placeholder.sub('?', shape)
+    shape = _number_literal.sub('?', shape)
+    shape = _in_list.sub('IN (...)', shape)
+    return ' '.join(shape.split())
+
+
+_string_literal = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_placeholder = re.compile(r'%s|%\(\w+\)s')
+_number_literal = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])')
+_in_list = re.compile(r'IN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
+
+def call_site():
+    '''Returns description of the first frame outside this module.
+
+    Worker threads of fan_out return call site of the calling thread.
+    '''
+    site = getattr(_local, 'call_site', None)
+    if site is not None:
+        return site
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename not in _internal_files:
+            return '%s:%s in %s' % (frame.filename, frame.lineno, frame.name)
+    return None
+
+
+_internal_files = (__file__, contextmanager.__code__.co_filename)
+
+
+def infile_value(value):
+    '''Escapes value for default format of LOAD DATA INFILE'''
+
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        value = value.isoformat(' ')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n'))
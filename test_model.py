@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 import pytest
 import json
+import threading
 from datetime import datetime
 from inspect import ismethoddescriptor
 import db
-from db import Model, Field, json_serial
+from db import Model, Field, Index, json_serial
 
 
 # Fixtures for Model
@@ -33,68 +34,299 @@ class TestSQLQuery:
 
     def test_all_model(self):
         query = Model.objects.all()
-        assert query._q == 'SELECT id FROM model'
+        assert query._q == 'SELECT `id` FROM `model`'
 
     def test_all_model_with_limit(self):
         query = Model.objects.all()[3]
-        assert query._q == 'SELECT id FROM model'
-        assert query._limit == 'LIMIT 3 '
+        assert query._q == 'SELECT `id` FROM `model`'
+        assert query._limit == (3, None)
 
     def test_all_model_with_advenced_limit(self):
         query = Model.objects.all()[3:7]
-        assert query._q == 'SELECT id FROM model'
-        assert query._limit == 'LIMIT 3, 4 '
+        assert query._q == 'SELECT `id` FROM `model`'
+        assert query._limit == (4, 3)
 
     def test_filter_model(self):
         query = Model.objects.filter(id=5)
-        assert query._q == 'SELECT id FROM model'
+        assert query._q == 'SELECT `id` FROM `model`'
         assert query._conditions == {'id': 5}
 
     def test_filter_with_limit(self):
         query = Model.objects.filter(id=5)[9]
-        assert query._q == 'SELECT id FROM model'
+        assert query._q == 'SELECT `id` FROM `model`'
         assert query._conditions == {'id': 5}
-        assert query._limit == 'LIMIT 9 '
+        assert query._limit == (9, None)
 
     def test_fluent_filter_model(self):
         query = Model.objects.filter(id=5).filter(list_id=11)
-        assert query._q == 'SELECT id FROM model'
+        assert query._q == 'SELECT `id` FROM `model`'
         assert query._conditions == {'id': 5, 'list_id': 11}
 
     def test_filter_greater_than(self):
         sql_query = Model.objects._parse_conditions_to_sql(id__gt=1)
-        assert sql_query == ' WHERE id > \'1\''
+        assert sql_query == (' WHERE `id` > %s', [1])
 
     def test_filter_greater_than_or_equal(self):
         sql_query = Model.objects._parse_conditions_to_sql(id__gte=1)
-        assert sql_query == ' WHERE id >= \'1\''
+        assert sql_query == (' WHERE `id` >= %s', [1])
 
     def test_fluent_all_model_order_by_and_advenced_limit(self):
         query = Model.objects.all().order_by('-id')[3:7]
-        assert query._q == 'SELECT id FROM model'
-        assert query._limit == 'LIMIT 3, 4 '
-        assert query._order_by == 'ORDER BY id DESC'
+        assert query._q == 'SELECT `id` FROM `model`'
+        assert query._limit == (4, 3)
+        assert query._order_by == (('id', 'DESC'), )
 
     def test_kwargs_to_sql_query_parse(self):
         sql_query = Model.objects._parse_conditions_to_sql(id=1)
-        assert sql_query == ' WHERE id = \'1\''
+        assert sql_query == (' WHERE `id` = %s', [1])
+
+    def test_unknown_lookup(self):
+        with pytest.raises(ValueError):
+            Model.objects._parse_conditions_to_sql(id__in=[1])
+
+    def test_lookups(self):
+        assert HelperModel.Lookups['name'] == ('name', '=')
+        assert HelperModel.Lookups['list_id__lte'] == ('list_id', '<=')
+        assert Model.objects._parse_to_sign('id__like') == ('id', 'like')
+        assert 'name' not in Model.Lookups
+
+    def test_sql_fragments_are_cached(self):
+        fragments = HelperModel._sql()
+        assert HelperModel._sql() is fragments
+        assert fragments['insert'] == 'INSERT INTO `helpermodel` (`id`, `list_id`, `name`) VALUES (%s, %s, %s)'
+        assert fragments['delete'] == 'DELETE FROM `helpermodel` WHERE `id` = %s'
+        sqlite = db.SQLiteBackend()
+        assert HelperModel._sql(sqlite)['count'] == 'SELECT COUNT(*) FROM "helpermodel"'
 
     def test_create_update_sql(self):
         mock_instance = HelperModel(name='Something to do', list_id=1)
         mock_instance.id = 5
-        sql_query = mock_instance.objects._create_update_sql()
-        assert sql_query == "UPDATE helpermodel SET id = '5', list_id = '1', name = 'Something to do' WHERE id = 5"
+        sql_query, params = mock_instance.objects._create_update_sql()
+        assert sql_query == "UPDATE `helpermodel` SET `id` = %s, `list_id` = %s, `name` = %s WHERE `id` = %s"
+        assert params == [5, 1, 'Something to do', 5]
 
     def test_create_update_sql_from_kwargs(self):
         sql_query = HelperModel.objects._create_update_sql_from_kwargs(
             name="Beer")
-        assert sql_query == "UPDATE helpermodel SET name = 'Beer'"
+        assert sql_query == ("UPDATE `helpermodel` SET `name` = %s", ['Beer'])
 
     def test_value_parse_to_dict(self):
         dict_value = HelperModel._value_parse_to_dict(1, 6, 'Buy new computer')
         assert dict_value == {
             'name': 'Buy new computer', 'list_id': 6, 'id': 1}
 
+    def test_create_bulk_insert_sql(self):
+        sql_query, params = HelperModel.objects._create_bulk_insert_sql(
+            [(None, 1, 'Beer'), (None, 2, 'Cat')])
+        assert sql_query == 'INSERT INTO `helpermodel` (`id`, `list_id`, `name`) VALUES (%s, %s, %s), (%s, %s, %s)'
+        assert params == [None, 1, 'Beer', None, 2, 'Cat']
+
+
+class TestSchema:
+
+    def test_indexes_from_fields_and_meta(self):
+        assert IndexedModel.Indexes == (
+            Index('code', unique=True), Index('person'),
+            Index('person', '-date'))
+
+    def test_index_name(self):
+        assert Index('person', '-date').index_name('event') == 'event_person_date_idx'
+        assert Index('code', unique=True).index_name('event') == 'event_code_uniq'
+        assert Index('code', name='by_code').index_name('event') == 'by_code'
+
+    def test_unknown_field_in_index(self):
+        with pytest.raises(ValueError):
+            class BrokenModel(Model):
+                name = Field()
+
+                class Meta:
+                    indexes = [('name', 'nothing')]
+
+    def test_schema_sql(self):
+        assert IndexedModel.schema_sql() == [
+            'CREATE TABLE IF NOT EXISTS `indexedmodel` (\n'
+            '    `id` INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,\n'
+            '    `code` VARCHAR(255),\n'
+            '    `date` DATETIME,\n'
+            '    `person` CHAR(12) NOT NULL\n)',
+            'CREATE UNIQUE INDEX `indexedmodel_code_uniq` ON `indexedmodel` (`code`)',
+            'CREATE INDEX `indexedmodel_person_idx` ON `indexedmodel` (`person`)',
+            'CREATE INDEX `indexedmodel_person_date_idx` ON `indexedmodel` (`person`, `date` DESC)']
+
+
+class TestReadRecords:
+
+    def test_read_csv_with_mapping(self, tmpdir):
+        path = tmpdir.join('models.csv')
+        path.write('Title,list_id\nBeer,1\nCat,\nBroken,1,2\n')
+        records = list(db.read_records(str(path), mapping={'Title': 'name'}))
+        assert records == [{'name': 'Beer', 'list_id': '1'},
+                           {'name': 'Cat', 'list_id': None}, None]
+
+    def test_read_ndjson(self, tmpdir):
+        path = tmpdir.join('models.ndjson')
+        path.write('{"name": "Beer", "list_id": 1}\nnot json\n\n[1]\n')
+        records = list(db.read_records(str(path), format='ndjson'))
+        assert records == [{'name': 'Beer', 'list_id': 1}, None, None]
+
+    def test_unknown_format(self, tmpdir):
+        with pytest.raises(ValueError):
+            list(db.read_records(str(tmpdir.join('models.xml')), format='xml'))
+
+    def test_infile_value(self):
+        assert db.infile_value(None) == '\\N'
+        assert db.infile_value('a\tb\\') == 'a\\tb\\\\'
+
+
+def make_event(duration, model=None, operation='get', error=None):
+    event = db.QueryEvent('SELECT 1', model=model, operation=operation)
+    event.duration = duration
+    event.rowcount = 1
+    event.error = error
+    return event
+
+
+class TestInstrumentation:
+
+    def test_stats_snapshot(self):
+        stats = db.QueryStats(buckets=(0.01, 0.1))
+        stats(make_event(0.005, Model))
+        stats(make_event(0.05, Model))
+        stats(make_event(2, Model, error=Exception()))
+        counters = stats.snapshot()['Model']['get']
+        assert counters['count'] == 3
+        assert counters['errors'] == 1
+        assert counters['rows'] == 3
+        assert counters['histogram'] == {0.01: 1, 0.1: 2, float('inf'): 3}
+
+    def test_stats_reset(self):
+        stats = db.QueryStats()
+        stats(make_event(0.005))
+        stats.reset()
+        assert stats.snapshot() == {}
+
+    def test_slow_query_log(self, caplog):
+        slow_log = db.SlowQueryLog(threshold=0.1)
+        with caplog.at_level('WARNING', logger='db.slow_query'):
+            slow_log(make_event(0.05, Model))
+            slow_log(make_event(0.5, Model))
+        assert len(caplog.records) == 1
+        assert 'Model.get' in caplog.records[0].getMessage()
+
+    def test_add_and_remove_listener(self):
+        @db.after_execute
+        def listener(event):
+            pass
+        assert listener in db.listeners['after_execute']
+        db.remove_listener('after_execute', listener)
+        assert listener not in db.listeners['after_execute']
+
+    def test_instrumented_notifies_listeners(self):
+        events = []
+        db.add_listener('before_execute', events.append)
+        db.add_listener('after_execute', events.append)
+        try:
+            with pytest.raises(ValueError):
+                with db.instrumented('SELECT 1', model=Model) as event:
+                    raise ValueError()
+        finally:
+            db.remove_listener('before_execute', events.append)
+            db.remove_listener('after_execute', events.append)
+        assert events == [event, event]
+        assert isinstance(event.error, ValueError)
+        assert event.duration is not None
+
+
+class TestPlanWarnings:
+
+    def test_mysql_json_plan(self):
+        plan = {'query_block': {'select_id': 1, 'ordering_operation': {
+            'using_filesort': True, 'grouping_operation': {
+                'using_temporary_table': True, 'table': {
+                    'table_name': 'eventmodel', 'access_type': 'ALL'}}}}}
+        assert db.MySQLBackend().plan_warnings(plan) == [
+            'filesort', 'temporary table', 'full scan of eventmodel']
+
+    def test_mysql_traditional_plan(self):
+        plan = [{'table': 'eventmodel', 'type': 'ref', 'Extra': 'Using where'},
+                {'table': 'helpermodel', 'type': 'ALL',
+                 'Extra': 'Using temporary; Using filesort'}]
+        assert db.MySQLBackend().plan_warnings(plan) == [
+            'full scan of helpermodel', 'filesort', 'temporary table']
+
+
+class FakeMultiCursor:
+
+    '''Cursor of MySQLdb with result sets of multi-statement query.'''
+
+    def __init__(self, results):
+        self.results = results
+        self.executed = []
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+
+    def fetchall(self):
+        return self.results[0]
+
+    def nextset(self):
+        self.results = self.results[1:]
+        return True if self.results else None
+
+
+class TestExecuteBatch:
+
+    def test_mysql_multi_statement(self):
+        cursor = FakeMultiCursor([((3, ), ), ((1, 'Beer'), )])
+        results = db.MySQLBackend().execute_batch(cursor, [
+            ('SELECT COUNT(*) FROM `model`', None),
+            ('SELECT `id`, `name` FROM `model` WHERE `id` = %s', [1])])
+        assert cursor.executed == [(
+            'SELECT COUNT(*) FROM `model`;\n'
+            'SELECT `id`, `name` FROM `model` WHERE `id` = %s', [1])]
+        assert results == [[(3, )], [(1, 'Beer')]]
+
+
+class TestQueryBudget:
+
+    def test_normalize_sql(self):
+        shape = db.normalize_sql(
+            "SELECT id FROM model WHERE id = '5' AND list_id IN (1, 2)")
+        assert shape == 'SELECT id FROM model WHERE id = ? AND list_id IN (...)'
+
+    def test_normalize_sql_with_params(self):
+        shape = db.normalize_sql('INSERT INTO model (id) VALUES (%s)')
+        assert shape == 'INSERT INTO model (id) VALUES (?)'
+
+    def test_max_queries(self):
+        with pytest.raises(db.QueryBudgetExceeded):
+            with db.query_budget(max_queries=2):
+                for number in range(3):
+                    db.check_budgets(make_event(0.001))
+
+    def test_repeated_query_warns(self):
+        with pytest.warns(db.RepeatedQueryWarning):
+            with db.query_budget(max_repeats=2, action='warn') as budget:
+                for number in range(5):
+                    event = make_event(0.001)
+                    event.statement = "SELECT id FROM model WHERE id = '%i'" % number
+                    db.check_budgets(event)
+        assert budget.queries == 5
+        (sites, ) = budget.repeated().values()
+        assert len(sites) == 5
+        assert 'test_model.py' in sites[0]
+        assert '5 x SELECT id FROM model WHERE id = ?' in budget.report()
+
+    def test_not_sampled_budget(self):
+        with db.query_budget(max_queries=0, sample_rate=0) as budget:
+            db.check_budgets(make_event(0.001))
+        assert budget.queries == 0
+
+    def test_budget_is_removed_after_scope(self):
+        with db.query_budget(max_queries=0):
+            pass
+        db.check_budgets(make_event(0.001))
+
 
 class BasicTestModel:
 
@@ -136,10 +368,9 @@ class TestModel(BasicTestModel):
         instance.id = 5
         assert instance.pk == instance.id
 
-    def test_one_field_values_to_str(self):
+    def test_one_field_values(self):
         instance = Model()
-        assert instance._fields_values_to_str(
-        ) == "(NULL)"
+        assert instance._fields_values() == (None, )
 
     def test_str(self):
         instance = Model()
@@ -212,6 +443,42 @@ class HelperModel(Model):
         db.execute_sql('DROP TABLE helpermodel')
 
 
+class IndexedModel(Model):
+
+    '''
+        Helper model for tests of schema
+    '''
+    person = Field(blank=False, null=False, db_type='CHAR(12)', db_index=True)
+    date = Field(db_type='DATETIME')
+    code = Field(unique=True)
+
+    class Meta:
+        indexes = [('person', '-date')]
+
+
+class LoadedModel(Model):
+
+    '''
+        Helper model for tests of coalescing of get
+    '''
+    name = Field()
+
+    class Meta:
+        loader = db.Loader(max_batch_size=10, wait=0.5)
+
+
+class LogModel(Model):
+
+    '''
+        Helper model for tests of write-behind
+    '''
+    name = Field()
+
+    class Meta:
+        write_behind = db.WriteBehind(max_size=3, batch_size=2,
+                                      interval=0.05, timeout=0)
+
+
 # Fixtures for HelperModel
 
 @pytest.fixture(scope='function')
@@ -257,11 +524,11 @@ class TestHelperModel(BasicTestHelperModel):
         assert instance.__repr__() == '<HelperModel: Something to do>'
 
     def test_parse_fields(self):
-        assert HelperModel._parse_fields() == 'id, list_id, name'
+        assert HelperModel._parse_fields() == '`id`, `list_id`, `name`'
 
     def test_simple_query(self):
         assert HelperModel._simple_query(
-        ) == 'SELECT id, list_id, name FROM helpermodel'
+        ) == 'SELECT `id`, `list_id`, `name` FROM `helpermodel`'
 
     def test_initializer(self):
         instance = HelperModel(id=5, list_id=7, name='Help', nothing=54)
@@ -270,11 +537,10 @@ class TestHelperModel(BasicTestHelperModel):
         assert instance.id is None
         assert hasattr(instance, 'nothing') is False
 
-    def test_fields_values_to_str(self):
+    def test_fields_values(self):
         instance = HelperModel()
         instance.name = 'Something'
-        assert instance._fields_values_to_str(
-        ) == "(NULL, NULL, 'Something')"
+        assert instance._fields_values() == (None, None, 'Something')
 
     def test_count_helpermodels(self):
         assert HelperModel.objects.count() == 0
@@ -283,6 +549,22 @@ class TestHelperModel(BasicTestHelperModel):
         HelperModel(name='Something', list_id=7).save()
         assert HelperModel.objects.count() == 1
 
+    def test_listener_gets_model_and_operation(self, instance_helpermodel):
+        events = []
+        db.add_listener('after_execute', events.append)
+        try:
+            HelperModel.objects.get(id=instance_helpermodel.id)
+        finally:
+            db.remove_listener('after_execute', events.append)
+        assert [(e.model, e.operation) for e in events] == [(HelperModel, 'get')]
+        assert events[0].rowcount == 1
+
+    def test_query_budget_detects_n_plus_one(self, list_helpermodel):
+        with pytest.raises(db.QueryBudgetExceeded):
+            with db.query_budget(max_repeats=3):
+                for instance in list_helpermodel:
+                    HelperModel.objects.get(id=instance.id)
+
     def test_read_helpermodel(self, instance_helpermodel):
         instance = HelperModel.objects.get(id=instance_helpermodel.id)
         assert instance.name == 'Something to do'
@@ -306,6 +588,24 @@ class TestHelperModel(BasicTestHelperModel):
         instance = HelperModel.objects.get(id=instance_id)
         assert instance.name == 'Cat'
 
+    def test_load_file_helpermodel(self, tmpdir):
+        path = tmpdir.join('helpermodels.csv')
+        path.write('list_id,name\n1,Beer\n2,\n3,Cat\n')
+        report = HelperModel.objects.load_file(str(path))
+        assert report.loaded == 2
+        assert report.rejected == 1
+        assert HelperModel.objects.count() == 2
+
+    def test_load_file_helpermodel_with_inserts(self, tmpdir):
+        path = tmpdir.join('helpermodels.ndjson')
+        path.write('{"list_id": 1, "name": "Beer"}\n'
+                   '{"list_id": 2, "name": "Cat"}\n')
+        report = HelperModel.objects.load_file(
+            str(path), format='ndjson', batch_size=1, local_infile=False)
+        assert report.method == 'insert'
+        assert report.loaded == 2
+        assert HelperModel.objects.count() == 2
+
     def test_get_or_create_helpermodel(self):
         HelperModel.objects.get_or_create(name='Inbox', id=5, list_id=6)
         assert HelperModel.objects.count() == 1
@@ -428,3 +728,800 @@ class TestForJsonFeature(BasicTestHelperModel):
         raw_json = HelperModel.objects.update(
             raw_json=helpermodel_json, resp_json=True)
         assert json.loads(raw_json) == {'id': 2, 'list_id': 3, 'name': 'Beer'}
+
+
+class TestSQLiteBackend:
+
+    @classmethod
+    def setup_class(cls):
+        cls.previous_backend = db.backends.pop('default', None)
+        db.use_backend('sqlite')
+        db.execute_sql('''
+        CREATE TABLE helpermodel(
+            id INTEGER PRIMARY KEY,
+            list_id INTEGER NOT NULL,
+            name CHAR(60) NOT NULL
+        )
+        ''')
+
+    @classmethod
+    def teardown_class(cls):
+        db.backends.pop('default')
+        if cls.previous_backend is not None:
+            db.backends['default'] = cls.previous_backend
+
+    def teardown_method(self):
+        db.execute_sql('DELETE FROM helpermodel')
+
+    def test_dialect(self):
+        query = HelperModel.objects.filter(name='Beer').order_by('-id')[2:4]
+        query._build_query()
+        assert query._q == 'SELECT "id", "list_id", "name" FROM "helpermodel" WHERE "name" = ? ORDER BY "id" DESC LIMIT 2 OFFSET 2'
+        assert query._params == ['Beer']
+
+    def test_save_and_get(self):
+        instance = HelperModel(name='Beer', list_id=1).save()
+        assert instance.id
+        assert HelperModel.objects.get(id=instance.id).name == 'Beer'
+
+    def test_filter_order_by_limit(self, list_helpermodel):
+        instances = HelperModel.objects.filter(list_id=2).order_by('-id')[0:1]
+        assert [instance.name for instance in instances] == ['Buy carrot']
+
+    def test_update_and_delete(self, instance_helpermodel):
+        instance_helpermodel.name = "It's beer"
+        instance_helpermodel.update()
+        instance = HelperModel.objects.get(id=instance_helpermodel.id)
+        assert instance.name == "It's beer"
+        instance.delete()
+        assert HelperModel.objects.count() == 0
+
+    def test_json(self, list_helpermodel, helpermodels_in_dict):
+        raw_json = HelperModel.objects.all().json()
+        assert json.loads(raw_json) == helpermodels_in_dict
+
+    def test_iterator(self, list_helpermodel):
+        instances = HelperModel.objects.filter(list_id=1).iterator()
+        assert [instance.id for instance in instances] == [1, 4]
+
+    def test_create_table_and_sync_schema(self):
+        IndexedModel.create_table()
+        try:
+            # Second call creates only missing indexes
+            IndexedModel.create_table()
+            assert db.make_migration(IndexedModel) == []
+            db.execute_sql('DROP INDEX "indexedmodel_person_date_idx"')
+            db.execute_sql('CREATE INDEX "by_date" ON "indexedmodel" ("date")')
+            assert IndexedModel.sync_schema(drop_indexes=True) == [
+                'CREATE INDEX "indexedmodel_person_date_idx" ON "indexedmodel" ("person", "date" DESC)',
+                'DROP INDEX "by_date"']
+            assert db.make_migration(IndexedModel, drop_indexes=True) == []
+        finally:
+            IndexedModel.drop_table()
+
+    def test_migration_adds_column(self):
+        db.execute_sql('CREATE TABLE indexedmodel (id INTEGER PRIMARY KEY, person CHAR(12))')
+        try:
+            statements = db.make_migration(IndexedModel)
+        finally:
+            IndexedModel.drop_table()
+        assert statements[:2] == [
+            'ALTER TABLE "indexedmodel" ADD COLUMN "code" VARCHAR(255)',
+            'ALTER TABLE "indexedmodel" ADD COLUMN "date" DATETIME']
+        assert len(statements) == 5
+
+    def test_explain(self, list_helpermodel):
+        query = HelperModel.objects.filter(list_id=2).order_by('-name')
+        plan = query.explain()
+        assert [row['detail'] for row in plan] == [
+            'SCAN helpermodel', 'USE TEMP B-TREE FOR ORDER BY']
+        assert db.get_backend().plan_warnings(plan) == [
+            'full scan of helpermodel', 'filesort']
+        # Query isn't changed by explain
+        assert [instance.name for instance in query] == [
+            'Read a book', 'Buy carrot']
+
+    def test_plan_capture(self, list_helpermodel, caplog):
+        capture = db.PlanCapture(threshold=0)
+        db.add_listener('after_execute', capture)
+        try:
+            HelperModel.objects.filter(name='Buy milk').json()
+            HelperModel.objects.filter(name='Buy beer').json()
+            HelperModel.objects.get(id=1)
+        finally:
+            db.remove_listener('after_execute', capture)
+        (scan, by_id) = capture.plans.values()
+        assert scan['warnings'] == ['full scan of helpermodel']
+        assert scan['model'] == 'HelperModel'
+        assert __file__ in scan['call_site']
+        assert by_id['warnings'] == []
+        assert 'full scan of helpermodel' in caplog.text
+
+    def test_plan_capture_skips_batch(self, list_helpermodel, caplog):
+        capture = db.PlanCapture(threshold=0)
+        db.add_listener('after_execute', capture)
+        try:
+            with db.batch():
+                HelperModel.objects.count()
+                HelperModel.objects.get(id=1)
+        finally:
+            db.remove_listener('after_execute', capture)
+        assert capture.plans == {}
+        assert 'failed' not in caplog.text
+
+    def test_batch(self, list_helpermodel):
+        events = []
+        db.add_listener('after_execute', events.append)
+        try:
+            with db.batch():
+                total = HelperModel.objects.count()
+                instances = HelperModel.objects.filter(list_id=2).order_by(
+                    '-id')()
+                instance = HelperModel.objects.get(id=1)
+                missing = HelperModel.objects.get(id=100, resp_json=True)
+                with pytest.raises(RuntimeError):
+                    total.result()
+        finally:
+            db.remove_listener('after_execute', events.append)
+        assert total.result() == 4
+        assert [item.name for item in instances.result()] == [
+            'Buy carrot', 'Read a book']
+        assert instance.result().id == 1
+        assert missing.result() is None
+        assert [event.operation for event in events] == ['batch']
+
+    def test_batch_runs_immediately_when_result_is_needed(self,
+                                                          list_helpermodel):
+        with db.batch():
+            query = HelperModel.objects.filter(list_id=2)
+            assert len(query) == 2
+            assert 'Read a book' in repr(HelperModel.objects.all())
+            instance = HelperModel.objects.get_or_create(
+                id=100, name='Beer', list_id=3)
+            assert isinstance(instance, HelperModel)
+            assert HelperModel.objects.get_or_create(id=1).name == 'Something to do'
+            updated = HelperModel.objects.update(id=1, name='Buy wine')
+            assert updated.name == 'Buy wine'
+        assert HelperModel.objects.count() == 5
+
+    def test_batch_error(self):
+        with pytest.raises(db.DatabaseError):
+            with db.batch():
+                total = HelperModel.objects.count()
+                db.current_batch().defer(
+                    [(None, 'SELECT * FROM missing_table', None)], list)
+        with pytest.raises(db.DatabaseError):
+            total.result()
+
+    def get_concurrently(self, ids):
+        events = []
+        db.add_listener('after_execute', events.append)
+        results = {}
+
+        def get(position, id):
+            results[position] = LoadedModel.objects.get(id=id)
+        threads = [threading.Thread(target=get, args=(position, id))
+                   for position, id in enumerate(ids)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            db.remove_listener('after_execute', events.append)
+        return [results[position] for position in range(len(ids))], events
+
+    def test_loader_coalesces_get(self):
+        LoadedModel.create_table()
+        try:
+            for name in ('Beer', 'Cat', 'Dog'):
+                LoadedModel.objects.create(name=name)
+            instances, events = self.get_concurrently([1, 2, 2, 3, 100])
+            assert [instance and instance.name for instance in instances] == [
+                'Beer', 'Cat', 'Cat', 'Dog', None]
+            assert instances[1] is not instances[2]
+            assert len(events) == 1
+            assert ' IN (?, ?, ?, ?)' in events[0].statement
+            # Full batch is loaded without waiting
+            LoadedModel.Loader.max_batch_size = 2
+            instances, events = self.get_concurrently([1, 2, 3, 4])
+            assert len(events) == 2
+            with db.transaction():
+                assert LoadedModel.objects.get(id=1).name == 'Beer'
+        finally:
+            LoadedModel.Loader.max_batch_size = 10
+            LoadedModel.drop_table()
+
+    def test_write_behind(self):
+        LogModel.create_table()
+        buffer = LogModel.WriteBehind
+        try:
+            instances = [LogModel.objects.create(name='n%i' % number)
+                         for number in range(3)]
+            assert [instance.id for instance in instances] == [None] * 3
+            buffer.flush()
+            assert LogModel.objects.count() == 3
+            LogModel(name='Beer').save()
+            # Background thread saves row after interval
+            for _ in range(100):
+                if LogModel.objects.count() == 4:
+                    break
+                db.time.sleep(0.01)
+            assert LogModel.objects.count() == 4
+            metrics = buffer.snapshot()
+            assert metrics['written'] == 4
+            assert metrics['depth'] == 0
+            assert metrics['last_flush_latency'] is not None
+            with db.transaction():
+                assert LogModel(name='Cat').save().id
+        finally:
+            buffer.close()
+            LogModel.drop_table()
+
+    def test_write_behind_close_stops_worker(self):
+        LogModel.create_table()
+        buffer = LogModel.WriteBehind
+        try:
+            LogModel(name='Beer').save()
+            worker = buffer._thread
+            buffer.close()
+            assert not worker.is_alive()
+            assert LogModel.objects.count() == 1
+            LogModel(name='Cat').save()
+            assert buffer._thread is not worker
+            buffer.flush()
+            assert LogModel.objects.count() == 2
+        finally:
+            buffer.close()
+            LogModel.drop_table()
+        assert [thread for thread in threading.enumerate()
+                if thread.name == 'db-write-behind-LogModel'] == []
+
+    def test_write_behind_is_not_inherited(self):
+        class ChildLogModel(LogModel):
+            pass
+        assert LogModel.WriteBehind.model is LogModel
+        assert ChildLogModel.WriteBehind is None
+        assert ChildLogModel.Loader is None
+        with pytest.raises(ValueError):
+            class OtherLogModel(LogModel):
+                class Meta:
+                    write_behind = LogModel.WriteBehind
+
+    def test_write_behind_backpressure(self):
+        buffer = db.WriteBehind(max_size=2, timeout=0)
+        buffer.model = LogModel
+        # Buffer without background thread
+        buffer._thread = threading.current_thread()
+        buffer.put((None, 'Beer'))
+        buffer.put((None, 'Cat'))
+        with pytest.raises(db.BufferFull):
+            buffer.put((None, 'Dog'))
+        assert buffer.depth == 2
+
+    def test_load_file_uses_inserts(self, tmpdir):
+        path = tmpdir.join('helpermodels.csv')
+        path.write('list_id,name\n1,Beer\n2,Cat\n')
+        report = HelperModel.objects.load_file(str(path))
+        assert report.method == 'insert'
+        assert report.loaded == 2
+
+    def test_load_file_inserts_in_batches(self, tmpdir):
+        path = tmpdir.join('helpermodels.csv')
+        path.write('list_id,name\n' + ''.join(
+            '%i,Item %i\n' % (number, number) for number in range(5)) +
+            '6,\n')
+        events = []
+        db.add_listener('after_execute', events.append)
+        try:
+            report = HelperModel.objects.load_file(str(path), batch_size=2)
+        finally:
+            db.remove_listener('after_execute', events.append)
+        assert (report.loaded, report.rejected) == (5, 1)
+        assert [event.rowcount for event in events] == [2, 2, 1]
+
+    def test_load_file_streams_to_load_data(self, tmpdir):
+        loaded = []
+
+        class LoadDataConnection:
+            def cursor(self):
+                return self
+
+            def execute(self, statement, params):
+                with open(params[0], encoding='utf-8') as infile:
+                    loaded.append((statement, infile.read()))
+                self.rowcount = 2
+
+            def commit(self):
+                pass
+
+            def close(self):
+                pass
+
+        backend = db.get_backend()
+        backend.supports_load_data = True
+        backend.connect = lambda **kwargs: LoadDataConnection()
+        path = tmpdir.join('helpermodels.csv')
+        path.write_text('list_id,name\n1,Piwo\n2,Žółw\n3,\n',
+                        encoding='utf-8')
+        try:
+            report = HelperModel.objects.load_file(str(path))
+        finally:
+            del backend.supports_load_data, backend.connect
+        assert report.method == 'load_data'
+        assert (report.loaded, report.rejected) == (2, 1)
+        ((statement, content), ) = loaded
+        assert 'INTO TABLE "helpermodel" CHARACTER SET utf8mb4 (' in statement
+        assert content == '\\N\t1\tPiwo\n\\N\t2\tŽółw\n'
+
+
+class TestReplicaRouting:
+
+    @classmethod
+    def setup_class(cls):
+        cls.previous_backend = db.backends.pop('default', None)
+        for alias in ('default', 'replica1', 'replica2'):
+            db.use_backend('sqlite', alias=alias)
+            db.execute_sql('CREATE TABLE model (id INTEGER PRIMARY KEY)',
+                           using=alias)
+        # Replicas have other rows than primary
+        db.execute_sql('INSERT INTO model VALUES (1), (2)', using='replica1')
+        db.execute_sql('INSERT INTO model VALUES (1), (2)', using='replica2')
+
+    @classmethod
+    def teardown_class(cls):
+        for alias in ('default', 'replica1', 'replica2'):
+            db.backends.pop(alias)
+        if cls.previous_backend is not None:
+            db.backends['default'] = cls.previous_backend
+
+    def setup_method(self):
+        db.use_replicas('replica1', 'replica2')
+
+    def teardown_method(self):
+        db.use_replicas()
+        db.execute_sql('DELETE FROM model')
+
+    def test_reads_go_to_replicas(self):
+        Model().save()
+        assert Model.objects.count() == 2
+        assert len(Model.objects.all()) == 2
+        assert Model.objects.using('primary').count() == 1
+
+    def test_round_robin(self):
+        assert [db.router.route('get') for _ in range(3)] == [
+            'replica1', 'replica2', 'replica1']
+
+    def test_least_latency(self):
+        db.use_replicas('replica1', 'replica2', strategy='least_latency')
+        db.router.latency['replica1'] = 0.5
+        assert db.router.route('count') == 'replica2'
+        event = make_event(5)
+        event.using = 'replica2'
+        db.router(event)
+        assert db.router.route('count') == 'replica1'
+
+    def test_using_alias(self):
+        assert Model.objects.using('replica2').count() == 2
+        assert db.router.route('insert', 'replica') in ('replica1', 'replica2')
+
+    def test_request_scope_reads_own_writes(self):
+        with db.request_scope():
+            assert Model.objects.count() == 2
+            Model().save()
+            assert Model.objects.count() == 1
+        assert Model.objects.count() == 2
+
+    def test_transaction_uses_primary(self):
+        with db.transaction():
+            Model().save()
+            assert Model.objects.count() == 1
+        assert Model.objects.using('primary').count() == 1
+
+    def test_transaction_rollback(self):
+        with pytest.raises(ValueError):
+            with db.transaction():
+                Model().save()
+                raise ValueError()
+        assert Model.objects.using('primary').count() == 0
+
+    def test_replica_with_open_circuit_is_skipped(self):
+        breaker = db.get_backend('replica1').breaker
+        breaker.opened_at = db.time.monotonic()
+        try:
+            assert [db.router.route('get') for _ in range(3)] == [
+                'replica2'] * 3
+        finally:
+            breaker.success()
+
+
+class FlakyBackend(db.SQLiteBackend):
+
+    '''Raises 'database is locked' for the first statements.'''
+
+    def __init__(self, failures=0, **params):
+        super().__init__(**params)
+        self.failures = failures
+        self.calls = 0
+
+    def execute(self, cursor, statement, params=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.driver.OperationalError('database is locked')
+        return super().execute(cursor, statement, params)
+
+
+class TestResilience:
+
+    @classmethod
+    def setup_class(cls):
+        cls.previous_backend = db.backends.pop('default', None)
+
+    @classmethod
+    def teardown_class(cls):
+        db.backends.pop('default', None)
+        if cls.previous_backend is not None:
+            db.backends['default'] = cls.previous_backend
+
+    def use_flaky(self, failures, **params):
+        backend = db.use_backend(FlakyBackend(backoff=0, **params))
+        db.execute_sql('CREATE TABLE model (id INTEGER PRIMARY KEY)')
+        backend.failures = failures
+        backend.calls = 0
+        return backend
+
+    def test_error_of_database_is_typed(self):
+        db.use_backend('sqlite')
+        with pytest.raises(db.DatabaseError) as error:
+            db.execute_sql('SELECT * FROM missing_table')
+        assert not isinstance(error.value, db.OperationalError)
+        assert isinstance(error.value.original, Exception)
+
+    def test_read_is_retried(self):
+        backend = self.use_flaky(2)
+        assert Model.objects.count() == 0
+        assert backend.calls == 3
+
+    def test_read_fails_after_retries(self):
+        backend = self.use_flaky(5, retries=2)
+        with pytest.raises(db.OperationalError):
+            Model.objects.count()
+        assert backend.calls == 3
+
+    def test_write_is_not_retried(self):
+        backend = self.use_flaky(1)
+        with pytest.raises(db.OperationalError):
+            Model().save()
+        assert backend.calls == 1
+
+    def test_migration_raises_error_of_schema_query(self):
+        backend = self.use_flaky(1)
+        with pytest.raises(db.OperationalError):
+            db.make_migration(Model)
+        assert backend.calls == 1
+        assert db.make_migration(Model) == []
+
+    def test_transaction_fails_after_lost_connection(self, tmp_path):
+        backend = self.use_flaky(0, database=str(tmp_path / 'lost.sqlite'))
+        with pytest.raises(db.TransactionAborted):
+            with db.transaction():
+                Model().save()
+                backend.failures = backend.calls + 1
+                with pytest.raises(db.OperationalError):
+                    Model().save()
+                with pytest.raises(db.TransactionAborted):
+                    Model().save()
+        assert Model.objects.count() == 0
+        with db.transaction():
+            Model().save()
+        assert Model.objects.count() == 1
+
+    def test_timeout(self):
+        db.use_backend('sqlite')
+        statement = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                     'SELECT i + 1 FROM n) SELECT count(*) FROM n')
+        with pytest.raises(db.QueryTimeout):
+            db.execute_sql(statement, operation='select', timeout=0.05)
+        # Connection works after cancelled statement
+        assert db.execute_sql('SELECT 1').fetchone() == (1, )
+
+    def test_idle_connection_is_opened_again(self, tmp_path):
+        class ClosedByServer(db.SQLiteBackend):
+            def ping(self, conn):
+                raise self.driver.OperationalError('server has gone away')
+        backend = db.use_backend(ClosedByServer(
+            database=str(tmp_path / 'idle.sqlite'), ping_interval=0))
+        first = backend.connection()
+        assert backend.connection() is not first
+        db.execute_sql('CREATE TABLE model (id INTEGER PRIMARY KEY)')
+        Model().save()
+        with db.transaction():
+            conn = backend.connection()
+            assert backend.connection() is conn
+        backend.ping_interval = 60
+        assert backend.connection() is backend.connection()
+
+    def test_slow_cancel_does_not_block_watchdog(self):
+        cancelled = []
+
+        class SlowBackend:
+            def cancel(self, conn):
+                db.time.sleep(0.5)
+                cancelled.append(conn)
+        deadlines = [db.Deadline(SlowBackend(), conn) for conn in (1, 2)]
+        for timeout, deadline in zip((0.01, 0.02), deadlines):
+            db.watchdog.schedule(timeout, deadline.fire)
+        db.time.sleep(0.2)
+        assert [deadline.fired for deadline in deadlines] == [True, True]
+        assert cancelled == []
+
+    def test_cancel_after_statement_is_skipped(self, tmp_path):
+        cancelled = []
+
+        class LateCancel(db.SQLiteBackend):
+            reconnect_after_cancel = True
+
+            def cancel(self, conn):
+                cancelled.append(conn)
+        backend = LateCancel(database=str(tmp_path / 'late.sqlite'))
+        deadline = db.Deadline(backend, None)
+        deadline.finish()
+        deadline._cancel()
+        assert not deadline.fired
+        assert cancelled == []
+        # Statement finished after cancel, connection is opened again
+        conn = backend.connection()
+        with backend.deadline(conn, 0.01) as deadline:
+            db.time.sleep(0.2)
+        assert deadline.fired
+        assert cancelled == [conn]
+        assert backend.connection() is not conn
+
+    def test_circuit_breaker(self):
+        backend = self.use_flaky(3, retries=0, failure_threshold=3,
+                                 reset_timeout=60)
+        for _ in range(3):
+            with pytest.raises(db.OperationalError):
+                Model.objects.count()
+        with pytest.raises(db.CircuitOpenError):
+            Model.objects.count()
+        assert backend.calls == 3
+        # After reset_timeout one statement tries database again
+        backend.breaker.reset_timeout = 0
+        assert Model.objects.count() == 0
+        assert not backend.breaker.is_open()
+
+    def test_trial_with_error_of_statement_closes_circuit(self):
+        backend = self.use_flaky(1, retries=0, failure_threshold=1,
+                                 reset_timeout=0)
+        with pytest.raises(db.OperationalError):
+            Model.objects.count()
+        # Database answered with error of statement to trial
+        with pytest.raises(db.DatabaseError):
+            db.execute_sql('SELECT * FROM missing_table')
+        assert db.execute_sql('SELECT 1').fetchone() == (1, )
+        assert backend.breaker.opened_at is None
+
+
+SHARDS = ('shard0', 'shard1', 'shard2')
+
+
+class ShardedModel(Model):
+
+    '''
+        Helper model sharded by hash of person
+    '''
+    person = Field(blank=False, null=False)
+    amount = Field(db_type='INTEGER')
+
+    class Meta:
+        shard_map = db.HashShardMap('person', SHARDS)
+
+
+class RangeShardedModel(Model):
+
+    '''
+        Helper model sharded by ranges of id
+    '''
+    name = Field()
+
+    class Meta:
+        shard_map = db.RangeShardMap(
+            'id', [(0, 'shard0'), (100, 'shard1'), (200, 'shard2')])
+
+
+@pytest.fixture(scope='class')
+def sqlite_shards(tmp_path_factory):
+    '''
+    Registers every shard as own SQLite database and creates tables
+    '''
+    directory = tmp_path_factory.mktemp('shards')
+    for alias in SHARDS:
+        db.use_backend('sqlite', alias=alias,
+                       database=str(directory.joinpath(alias + '.sqlite')))
+    ShardedModel.create_table()
+    RangeShardedModel.create_table()
+    yield SHARDS
+    for alias in SHARDS:
+        db.backends.pop(alias).disconnect()
+
+
+def shard_counts(model):
+    return [model.objects.using(alias).count() for alias in SHARDS]
+
+
+class TestShardMap:
+
+    def test_hash_shard_map_is_stable(self):
+        shard_map = db.HashShardMap('person', SHARDS)
+        assert shard_map.shard_for('@all') == shard_map.shard_for('@all')
+        assert set(shard_map.shard_for('@%i' % i) for i in range(30)) == set(SHARDS)
+
+    def test_range_shard_map(self):
+        shard_map = RangeShardedModel.ShardMap
+        assert shard_map.shard_for(5) == 'shard0'
+        assert shard_map.shard_for(100) == 'shard1'
+        assert shard_map.shard_for(10 ** 6) == 'shard2'
+        with pytest.raises(ValueError):
+            shard_map.shard_for(-1)
+        with pytest.raises(ValueError):
+            shard_map.shard_for(None)
+
+    def test_unknown_shard_key(self):
+        with pytest.raises(ValueError):
+            class BrokenModel(Model):
+                class Meta:
+                    shard_map = db.HashShardMap('nothing', SHARDS)
+
+    def test_merge_sorted(self):
+        rows = db.merge_sorted([[(3, None), (1, 'b')], [(4, 'c'), (2, 'a')]],
+                               (('id', 'DESC'), ), ('id', 'name'))
+        assert [row[0] for row in rows] == [4, 3, 2, 1]
+        rows = db.merge_sorted([[(3, None), (1, 'b')], [(2, 'a'), (4, 'c')]],
+                               (('name', 'ASC'), ), ('id', 'name'))
+        assert [row[0] for row in rows] == [3, 2, 1, 4]
+
+
+@pytest.mark.usefixtures('sqlite_shards')
+class TestSharding:
+
+    def teardown_method(self):
+        for alias in SHARDS:
+            db.execute_sql('DELETE FROM shardedmodel', using=alias)
+            db.execute_sql('DELETE FROM rangeshardedmodel', using=alias)
+
+    def create_models(self):
+        for number in range(12):
+            ShardedModel.objects.create(person='@%i' % (number % 6),
+                                        amount=number)
+
+    def test_create_routes_to_shard(self):
+        instance = ShardedModel.objects.create(person='@all', amount=1)
+        alias = ShardedModel.ShardMap.shard_for('@all')
+        assert ShardedModel.objects.using(alias).count() == 1
+        assert ShardedModel.objects.count() == 1
+        assert instance.id
+
+    def test_filter_by_shard_key_uses_one_shard(self):
+        self.create_models()
+        events = []
+        db.add_listener('after_execute', events.append)
+        try:
+            instances = ShardedModel.objects.filter(person='@1')()
+        finally:
+            db.remove_listener('after_execute', events.append)
+        assert sorted(instance.amount for instance in instances) == [1, 7]
+        assert [event.using for event in events] == [
+            ShardedModel.ShardMap.shard_for('@1')]
+
+    def test_fan_out_with_order_by_and_limit(self):
+        self.create_models()
+        assert sum(shard_counts(ShardedModel)) == 12
+        instances = ShardedModel.objects.filter(amount__gte=2).order_by(
+            '-amount')[1:4]
+        assert [instance.amount for instance in instances] == [10, 9, 8]
+        assert len(ShardedModel.objects.all()) == 12
+
+    def test_fan_out_get_update_and_delete(self):
+        self.create_models()
+        instance = list(ShardedModel.objects.filter(person='@4'))[0]
+        found = ShardedModel.objects.get(amount=instance.amount)
+        assert found.person == '@4'
+        found.amount = 100
+        found.update()
+        assert ShardedModel.objects.get(person='@4', amount=100)
+        found.delete()
+        assert ShardedModel.objects.count() == 11
+        ShardedModel.objects.update(amount=0)
+        assert len(ShardedModel.objects.filter(amount=0)) == 11
+
+    def test_batch_merges_shards(self):
+        self.create_models()
+        events = []
+        db.add_listener('after_execute', events.append)
+        try:
+            with db.batch():
+                total = ShardedModel.objects.count()
+                instances = ShardedModel.objects.all().order_by('-amount')[0:3]()
+                instance = ShardedModel.objects.get(person='@2', amount=8)
+        finally:
+            db.remove_listener('after_execute', events.append)
+        assert total.result() == 12
+        assert [item.amount for item in instances.result()] == [11, 10, 9]
+        assert instance.result().person == '@2'
+        assert sorted(event.using for event in events) == list(SHARDS)
+
+    def test_id_writes_need_shard_key(self):
+        self.create_models()
+        with pytest.raises(ValueError):
+            ShardedModel.objects.delete(id=1)
+        with pytest.raises(ValueError):
+            ShardedModel.objects.update(id=2, amount=100)
+        with pytest.raises(ValueError):
+            ShardedModel.objects.update(id=2, person='@zzz')
+        with pytest.raises(ValueError):
+            ShardedModel.objects.get(id=1)
+        assert ShardedModel.objects.count() == 12
+        assert len(ShardedModel.objects.filter(amount=100)) == 0
+        instance = ShardedModel.objects.get(person='@1', amount=7)
+        assert ShardedModel.objects.get(id=instance.id, person='@1').amount == 7
+
+    def test_shard_key_of_instance_can_not_change(self):
+        instance = ShardedModel.objects.create(person='@1', amount=1)
+        instance.person = '@2'
+        with pytest.raises(ValueError):
+            instance.update()
+        instance = ShardedModel.objects.get(person='@1', amount=1)
+        instance.person = '@5'
+        with pytest.raises(ValueError):
+            instance.delete()
+        instance.person = '@1'
+        instance.delete()
+        assert ShardedModel.objects.count() == 0
+
+    def test_id_writes_on_model_sharded_by_id(self):
+        for number in (5, 150, 250):
+            RangeShardedModel.objects.create(id=number, name='n%i' % number)
+        RangeShardedModel.objects.update(id=150, name='Beer')
+        RangeShardedModel.objects.delete(id=5)
+        assert shard_counts(RangeShardedModel) == [0, 1, 1]
+        assert RangeShardedModel.objects.get(id=150).name == 'Beer'
+
+    def test_range_sharding_by_id(self):
+        for number in (5, 150, 250, 99):
+            RangeShardedModel.objects.create(id=number, name='n%i' % number)
+        assert shard_counts(RangeShardedModel) == [2, 1, 1]
+        assert RangeShardedModel.objects.get(id=150).name == 'n150'
+        instances = RangeShardedModel.objects.all().order_by('id')
+        assert [instance.id for instance in instances] == [5, 99, 150, 250]
+
+    def test_bulk_insert_groups_rows_by_shard(self, tmpdir):
+        path = tmpdir.join('sharded.ndjson')
+        path.write(''.join('{"person": "@%i", "amount": %i}\n' % (i, i)
+                           for i in range(9)))
+        report = ShardedModel.objects.load_file(str(path), format='ndjson')
+        assert report.loaded == 9
+        for number in range(9):
+            alias = ShardedModel.ShardMap.shard_for('@%i' % number)
+            assert ShardedModel.objects.using(alias).filter(
+                person='@%i' % number)()
+
+    def test_query_budget_counts_fan_out(self):
+        with db.query_budget() as budget:
+            ShardedModel.objects.count()
+        assert budget.queries == 3
+
+    def test_fan_out_without_budget_skips_call_site(self, monkeypatch):
+        sites = []
+        monkeypatch.setattr(db, 'call_site', lambda: sites.append(1))
+        assert ShardedModel.objects.count() == 0
+        assert sites == []
+
+    def test_query_budget_reports_call_site_of_fan_out(self):
+        with db.query_budget() as budget:
+            for _ in range(20):
+                ShardedModel.objects.count()
+        assert budget.queries == 60
+        [sites] = budget.shapes.values()
+        assert len(sites) == 60
+        assert all(site.startswith(__file__) for site in sites)